@@ -0,0 +1,19 @@
+# Benchmark for repeated pyImport calls. Run from the examples directory:
+# PYTHONPATH=$PWD:$PYTHONPATH python bench_plugin.py
+import timeit
+
+import nix
+import plugin_entry  # registers the primops, do this before nix.eval creates a State
+
+pyImport = nix.eval("pyImport")
+
+cases = [("os", "getcwd"), ("sys", "version"), ("base64", "b64encode")]
+
+for module, attr in cases:
+    start = timeit.default_timer()
+    pyImport(module)[attr].force()
+    print(f"first import of {module}: {timeit.default_timer() - start:.6f}s")
+
+for module, attr in cases:
+    times = timeit.repeat(lambda: pyImport(module)[attr].force(), number=100, repeat=5)
+    print(f"repeated import of {module}: {min(times) / 100:.6f}s per call")
@@ -1,54 +1,148 @@
+import hashlib
+import os
+
 import nix.expr
+from nix.expr import Value, PrimOp, ffi, lib
+
+# converted modules, by (state, module name), kept for the life of the process
+modules = {}
+
+
+def mapAttrs(st):
+    res = Value(st)
+    lib.nix_expr_eval_from_string(st, b"builtins.mapAttrs", b".", res._value)
+    return res
+
 
 def pyImport(x):
-    mod = __import__(str(x))
-    ret = {}
-    for key in dir(mod):
-        if not key[0] == '_':
-            val = getattr(mod, key)
-            try:
-                v = nix.expr.Value(nix.expr.PrimOp.calling_state.state, make_reference=True)
-                v.set(val)
-                ret[key] = v
-            except Exception as e:
-                print(key, "failed:", e)
-    return ret
+    st = PrimOp.calling_state.state
+    key = (int(ffi.cast("uintptr_t", st)), str(x))
+    if key not in modules:
+        mod = __import__(str(x))
+
+        # mapAttrs leaves its results as thunks,
+        # so attributes are only converted when nix selects them
+        def getAttr(name, _):
+            v = Value(PrimOp.calling_state.state)
+            v.set(getattr(mod, str(name)))
+            return v
+
+        names = {attr: None for attr in dir(mod) if not attr[0] == '_'}
+        modules[key] = mapAttrs(st)(getAttr)(names)
+    return modules[key]
 
 imp = nix.expr.PrimOp(pyImport)
 nix.expr.lib.nix_register_primop(imp._primop)
 
 
 
+def wasmConverter(valtype):
+    if str(valtype) in ("f32", "f64"):
+        return float
+    return int
+
+
 def wrapAsm(fun, store):
-    t = fun.type(store)
-    arity = len(t.params)
-    def arg0(x):
-        return fun(store)
-    def arg1(x):
-        return fun(store, x.force())
-    def arg2(x, y):
-        return fun(store, x.force(), y.force())
-    def arg3(x, y, z):
-        return fun(store, x.force(), y.force(), z.force())
-    return [arg0, arg1, arg2, arg3][arity]
+    # pick the argument converters once, from the signature
+    conv = [wasmConverter(t) for t in fun.type(store).params]
+    arity = len(conv)
+    if arity == 0:
+        def arg0(x):
+            return fun(store)
+        return arg0
+    if arity == 1:
+        c0, = conv
+        def arg1(x):
+            return fun(store, c0(x))
+        return arg1
+    if arity == 2:
+        c0, c1 = conv
+        def arg2(x, y):
+            return fun(store, c0(x), c1(y))
+        return arg2
+    if arity == 3:
+        c0, c1, c2 = conv
+        def arg3(x, y, z):
+            return fun(store, c0(x), c1(y), c2(z))
+        return arg3
+    raise TypeError(f"wasm functions with {arity} arguments are not supported")
 
 
-def wasmImport(x):
-    from wasmtime import Store, Module, Instance, WasiConfig, Linker
+# one store and linker for all wasm modules, created on first use
+wasm = None
+# sha256 digests, by (path, mtime, size)
+wasm_digests = {}
+# instantiated modules, by (path, digest)
+wasm_instances = {}
+# converted export sets, by (state, path, digest)
+wasm_values = {}
+
+
+def wasmRuntime():
+    global wasm
+    if wasm is None:
+        from wasmtime import Store, WasiConfig, Linker
+        store = Store()
+        store.set_wasi(WasiConfig())
+        linker = Linker(store.engine)
+        linker.define_wasi()
+        wasm = (store, linker)
+    return wasm
 
 
-    store = Store()
-    store.set_wasi(WasiConfig())
-    linker = Linker(store.engine)
-    linker.define_wasi()
+def wasmDigest(path):
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    if key not in wasm_digests:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        wasm_digests[key] = h.hexdigest()
+    return wasm_digests[key]
 
-    module = Module.from_file(store.engine, str(x))
-    instance = linker.instantiate(store, module)
-    ret = {}
-    for key, func in instance.exports(store)._extern_map.items():
-        if key != "memory":
-            ret[key] = wrapAsm(func, store)
-    return ret
+
+def wasmCompile(engine, path, digest):
+    """ Compile a module, using the serialized modules in $PYTHON_NIX_WASM_CACHE if set """
+    from wasmtime import Module
+    cache_dir = os.environ.get("PYTHON_NIX_WASM_CACHE")
+    if cache_dir is None:
+        return Module.from_file(engine, path)
+    cached = os.path.join(cache_dir, digest + ".cwasm")
+    if os.path.exists(cached):
+        try:
+            return Module.deserialize_file(engine, cached)
+        except Exception:
+            # serialized by an incompatible wasmtime, compile again
+            pass
+    module = Module.from_file(engine, path)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = cached + f".{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(module.serialize())
+    os.replace(tmp, cached)
+    return module
+
+
+def wasmImport(x):
+    path = os.path.abspath(str(x))
+    key = (path, wasmDigest(path))
+    if key not in wasm_instances:
+        store, linker = wasmRuntime()
+        module = wasmCompile(store.engine, path, key[1])
+        instance = linker.instantiate(store, module)
+        ret = {}
+        for name, func in instance.exports(store)._extern_map.items():
+            if name != "memory":
+                ret[name] = wrapAsm(func, store)
+        wasm_instances[key] = ret
+    st = PrimOp.calling_state.state
+    value_key = (int(ffi.cast("uintptr_t", st)),) + key
+    if value_key not in wasm_values:
+        v = Value(st)
+        v.set(wasm_instances[key])
+        wasm_values[value_key] = v
+    return wasm_values[value_key]
 
 imp2 = nix.expr.PrimOp(wasmImport)
 nix.expr.lib.nix_register_primop(imp2._primop)
@@ -19,7 +19,7 @@
           buildInputs = with pkgs; [
             (python3.withPackages
               (p: [ p.cffi p.pkgconfig p.setuptools p.build p.sphinx ]))
-            nix # from flake input
+            nix # from flake input, also provides its bdw-gc
             pkg-config
             ruff
             black
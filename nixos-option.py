@@ -1,9 +1,14 @@
 import nix
-import nix.util, nix.expr
+import nix.util, nix.expr, nix.flake
 from nix.expr import Type, Value
+from nix.derivation import is_derivation
 from dataclasses import dataclass
-from typing import Callable
+from typing import Callable, Optional
+import argparse
+import multiprocessing
+import os
 import sys
+import time
 
 nix.util.settings["extra-experimental-features"] = "flakes"
 
@@ -74,18 +79,14 @@ class Context:
     optionsRoot: Value
 
 def isOption(v: Value) -> bool:
-    try:
-        return v["_type"].force({Type.string}) == "option"
-    except TypeError:
-        return False
-    except KeyError:
-        return False
+    t = v.get("_type")
+    return t is not None and t.force_type() is Type.string and t.force() == "option"
 
 def quoteAttribute(attr: str) -> str:
     if isVarName(attr):
         return attr
     else:
-        return printStringValue(attr)
+        return print_string_value(attr)
 
 def forbiddenRecursionName(name: str) -> bool:
     return (name and name[0] == "_") or name == "haskellPackages"
@@ -99,7 +100,7 @@ def recurse(f: Callable[[str, Value | Exception], bool], v: Value, path: str) ->
         return
     if isinstance(evaluated, Exception):
         return
-    if evaluated.get_type() is not Types.attrs:
+    if evaluated.get_type() is not Type.attrs:
         return
     for name in evaluated:
         if not forbiddenRecursionName(name):
@@ -108,12 +109,8 @@ def recurse(f: Callable[[str, Value | Exception], bool], v: Value, path: str) ->
        
 
 def optionTypeIs(v: Value, soughtType: str) -> bool:
-    try:
-        return v["type"]["name"].force({Type.string}) == soughtType
-    except TypeError:
-        return False
-    except KeyError:
-        return False
+    name = v.try_select(["type", "name"])
+    return name is not None and name.force_type() is Type.string and name.force() == soughtType
 
 def isAggregateOptionType(v: Value) -> bool:
     return optionTypeIs(v, "attrsOf") or optionTypeIs(v, "listOf")
@@ -166,11 +163,11 @@ def mapConfigValuesInOption(
     try:
         # todo implement findAlongAttrPath
         option = findAlongAttrPath(path, cfg.configRoot)[0]
-     except Exception as e:
-         f(path, e)
-         return
+    except Exception as e:
+        f(path, e)
+        return
     def rec(path: str, v: Value | Exception) -> bool:
-        leaf = isinstance(v, Exception) or v.get_type() is not Types.attrs
+        leaf = isinstance(v, Exception) or v.get_type() is not Type.attrs
         if not leaf:
             return True
         f(path, v)
@@ -232,21 +229,112 @@ def printOne(ctx: Context, path: str):
         printListing(option)
 
 
+def describeValue(v: Value, depth: int = 0) -> str:
+    """ A canonical rendering of a config value, for comparing hosts. Attributes are sorted, derivations shown by path. """
+    try:
+        t = v.force_type()
+        if t is Type.attrs:
+            if is_derivation(v):
+                return "«derivation: " + str(v["drvPath"]) + "»"
+            if depth > 20:
+                return "«...»"
+            return "{ " + "".join(
+                quoteAttribute(name) + " = " + describeValue(v[name], depth + 1) + "; "
+                for name in sorted(v.keys())
+            ) + "}"
+        if t is Type.list:
+            return "[ " + "".join(describeValue(x, depth + 1) + " " for x in v) + "]"
+        if t is Type.string:
+            return print_string_value(str(v))
+        if t is Type.function:
+            return "«lambda»"
+        if t is Type.bool:
+            return "true" if bool(v) else "false"
+        if t is Type.null:
+            return "null"
+        return str(v)
+    except Exception as e:
+        return describeError(e)
+
+
+# the nixosConfigurations of the flake, in fleet worker processes
+_hosts: Optional[Value] = None
+
+
+def _init_fleet_worker(flake: str) -> None:
+    global _hosts
+    _hosts = nix.flake.Flake(flake).value["outputs"]["nixosConfigurations"]
+
+
+def _evaluate_host(task: tuple[str, list[str]]) -> tuple[str, dict[str, str], float]:
+    host, paths = task
+    assert _hosts is not None
+    start = time.monotonic()
+    res = {}
+    try:
+        config = _hosts[host]["config"]
+        for path in paths:
+            v = config.try_select(parse_attr_path(path))
+            res[path] = "«missing»" if v is None else describeValue(v)
+    except Exception as e:
+        for path in paths:
+            res.setdefault(path, describeError(e))
+    return host, res, time.monotonic() - start
+
+
+def fleet(flake: str, paths: list[str], jobs: Optional[int], hosts: Optional[list[str]] = None) -> None:
+    """ Evaluate `paths` on every nixosConfiguration in parallel, and print the values that differ between hosts """
+    if hosts is None:
+        hosts = nix.flake.Flake(flake)["nixosConfigurations"].keys()
+    hosts = [host for host in hosts if host]
+    if not hosts:
+        print("no hosts to compare", file=sys.stderr)
+        return
+    by_path: dict[str, dict[str, list[str]]] = {path: {} for path in paths}
+    # nix is not fork-safe, so start fresh workers
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(jobs or os.cpu_count(), initializer=_init_fleet_worker, initargs=(flake,)) as pool:
+        results = pool.imap_unordered(_evaluate_host, [(host, paths) for host in hosts])
+        for i, (host, values, elapsed) in enumerate(results, 1):
+            print(f"[{i}/{len(hosts)}] {host} ({elapsed:.1f}s)", file=sys.stderr)
+            for path, value in values.items():
+                by_path[path].setdefault(value, []).append(host)
+    for path, groups in by_path.items():
+        print(path + ":")
+        ordered = sorted(groups.items(), key=lambda g: -len(g[1]))
+        if not ordered:
+            print("  no values")
+            continue
+        if len(ordered) == 1:
+            print(f"  all {len(hosts)} hosts: {ordered[0][0]}")
+            continue
+        common, common_hosts = ordered[0]
+        print(f"  {len(common_hosts)} hosts: {common}")
+        for value, value_hosts in ordered[1:]:
+            print(f"  {', '.join(sorted(value_hosts))}: {value}")
+
+
 def main(args):
-    dotfiles = nix.eval("builtins.getFlake")("/home/yorick/dotfiles")
-    root = dotfiles["nixosConfigurations"]["blackadder"]
+    parser = argparse.ArgumentParser(description="Show the values of NixOS options")
+    parser.add_argument("options", nargs="*", help="option paths, like services.nginx.enable")
+    parser.add_argument("--flake", default="/home/yorick/dotfiles", help="the flake with the nixosConfigurations")
+    parser.add_argument("--host", default="blackadder", help="the nixosConfiguration to show")
+    parser.add_argument("--fleet", action="store_true", help="compare the options across all nixosConfigurations")
+    parser.add_argument("--hosts", help="comma separated nixosConfigurations to compare, instead of all")
+    parser.add_argument("--jobs", "-j", type=int, default=None, help="number of worker processes in fleet mode")
+    opts = parser.parse_args(args)
+    if opts.fleet:
+        fleet(opts.flake, opts.options, opts.jobs, opts.hosts.split(",") if opts.hosts else None)
+        return
+    dotfiles = nix.flake.Flake(opts.flake)
+    root = dotfiles["nixosConfigurations"][opts.host].value
     configRoot = root["config"]
     optionsRoot = root["options"]
     ctx = Context(configRoot, optionsRoot)
-    #print(dotfiles["nixosConfigurations"]["blackadder"]["config"]["boot"]["kernelModules"].force(deep=True))
     # todo recursive
-    if len(args) == 0:
-        pass
-    for arg in args:
+    for arg in opts.options:
         printOne(ctx, arg)
 
-main(sys.argv[1:])
-
-
-
 
+if __name__ == "__main__":
+    main(sys.argv[1:])
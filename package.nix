@@ -5,11 +5,12 @@ buildPythonPackage {
   format = "setuptools";
   src = ./.;
   propagatedBuildInputs = [ cffi ];
+  # bdw-gc is propagated by nix, so nix.gc links the same (patched) GC as libnixexpr
   buildInputs = [ nix ];
   nativeBuildInputs = [
     pkgconfig # is a python package
   ];
-  pythonImportsCheck = [ "nix" "nix.util" "nix.store" "nix.expr" ];
+  pythonImportsCheck = [ "nix" "nix.util" "nix.store" "nix.expr" "nix.gc" ];
   meta = with lib; {
     homepage = "https://github.com/tweag/python-nix";
     description = "Python Nix FFI";
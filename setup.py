@@ -6,7 +6,7 @@ from distutils.command.build import build
 from setuptools import setup
 from setuptools.command.install import install
 
-CFFI_MODULES = ["src/buildFFI.py:libutil", "src/buildFFI.py:libstore", "src/buildFFI.py:libexpr"]
+CFFI_MODULES = ["src/buildFFI.py:libutil", "src/buildFFI.py:libstore", "src/buildFFI.py:libexpr", "src/buildFFI.py:libgc"]
 SETUP_REQUIRES = ["cffi"]
 LIBRARIES = []
 
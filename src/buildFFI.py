@@ -12,10 +12,16 @@ def extract_cffi(fname):
 parsed = pkgconfig.parse("nix-expr-c nix-store-c")
 nix_headers = Path(parsed["include_dirs"][0])
     
-def make_ffi(name, headers, libraries, includes=[], extra_header=""):
+def make_ffi(name, headers, libraries, includes=[], extra_header="", extra_source="", cpp_packages=[]):
+    """ cpp_packages: pkg-config packages of the nix C++ API that extra_source uses, which makes it C++ """
     header_content = "\n".join([extract_cffi(nix_headers / p) for p in headers])
     if extra_header:
         header_content += "\n" + extra_header
+    include_dirs = list(parsed["include_dirs"])
+    cpp_args = {}
+    if cpp_packages:
+        include_dirs += pkgconfig.parse(" ".join(cpp_packages))["include_dirs"]
+        cpp_args = dict(source_extension=".cpp", extra_compile_args=["-std=c++2a"])
 
     ffi = FFI()
 
@@ -32,13 +38,35 @@ def make_ffi(name, headers, libraries, includes=[], extra_header=""):
     #include "nix_api_expr.h"
     #include "nix_api_value.h"
     #include "nix_api_external.h"
-    ''',
-                   libraries=parsed["libraries"],
+    ''' + extra_source,
+                   libraries=parsed["libraries"] + libraries,
                    library_dirs=parsed["library_dirs"],
-                   include_dirs=parsed["include_dirs"])
+                   include_dirs=include_dirs,
+                   **cpp_args)
     return ffi
 
-libutil = make_ffi("nix._nix_api_util", ["nix_api_util.h"], ["nixutilc"])
+libutil = make_ffi("nix._nix_api_util", ["nix_api_util.h"], ["nixutilc", "nixutil"], [], """
+void py_nix_set_interrupt_flag(int*);
+void py_nix_raise_interrupt_flag(int*);
+""", """
+#include "config.h"
+#include "util.hh"
+
+/* Make checkInterrupt() on the calling thread throw Interrupted once *flag is set,
+   without touching the process-wide flag that would interrupt every thread. NULL removes the check. */
+static void py_nix_set_interrupt_flag(int *flag)
+{
+    if (flag)
+        nix::interruptCheck = [flag]() { return __atomic_load_n(flag, __ATOMIC_RELAXED) != 0; };
+    else
+        nix::interruptCheck = nullptr;
+}
+
+static void py_nix_raise_interrupt_flag(int *flag)
+{
+    __atomic_store_n(flag, 1, __ATOMIC_RELAXED);
+}
+""", ["nix-store"])
 libstore = make_ffi("nix._nix_api_store", ["nix_api_store.h"], ["nixstorec"], [libutil])
 libexpr = make_ffi("nix._nix_api_expr", ["nix_api_expr.h", "nix_api_value.h", "nix_api_external.h"], ["nixexprc"], [libutil, libstore], """
 extern "Python" void py_nix_primop_base(void*, struct nix_c_context*, struct State*, void**, void*);
@@ -49,7 +77,74 @@ extern "Python" void py_nix_external_showType(void*, nix_string_return*);
 extern "Python" void py_nix_external_typeOf(void*, nix_string_return*);
 extern "Python" void py_nix_external_coerceToString(void*, nix_string_context*, int, int, nix_string_return*);
 extern "Python" int py_nix_external_equal(void*, void*);
+size_t strlen(const char*);
+int py_nix_state_write_stats(struct State*, const char*);
+""", """
+#include <string.h>
+#include <stdlib.h>
+#include <mutex>
+#include <string>
+#include "config.h"
+#include "eval.hh"
+
+/* The C API's State, as in nix_api_expr_internal.h, which isn't installed */
+struct State
+{
+    nix::EvalState state;
+};
+
+/* Write the statistics that NIX_SHOW_STATS prints to `path`, as JSON. Returns 0 on success. */
+static int py_nix_state_write_stats(struct State *state, const char *path)
+{
+    /* printStatistics() takes its destination from the environment */
+    static std::mutex lock;
+    std::lock_guard<std::mutex> guard(lock);
+    const char *old = getenv("NIX_SHOW_STATS_PATH");
+    std::string saved = old ? old : "";
+    setenv("NIX_SHOW_STATS_PATH", path, 1);
+    int res = 0;
+    try {
+        state->state.printStatistics();
+    } catch (...) {
+        res = -1;
+    }
+    if (old)
+        setenv("NIX_SHOW_STATS_PATH", saved.c_str(), 1);
+    else
+        unsetenv("NIX_SHOW_STATS_PATH");
+    return res;
+}
+""", ["nix-expr"])
+
+# the GC that nix propagates, which may be patched, not a separate boehmgc
+gc_parsed = pkgconfig.parse("bdw-gc")
+libgc = FFI()
+libgc.cdef("""
+typedef unsigned long... GC_word;
+void GC_gcollect(void);
+size_t GC_get_heap_size(void);
+size_t GC_get_free_bytes(void);
+size_t GC_get_bytes_since_gc(void);
+size_t GC_get_total_bytes(void);
+GC_word GC_get_gc_no(void);
+void GC_set_max_heap_size(GC_word);
+void GC_set_free_space_divisor(GC_word);
+GC_word GC_get_free_space_divisor(void);
+struct GC_stack_base { void *mem_base; ...; };
+#define GC_SUCCESS ...
+#define GC_DUPLICATE ...
+int GC_get_stack_base(struct GC_stack_base *);
+int GC_register_my_thread(const struct GC_stack_base *);
+int GC_unregister_my_thread(void);
+void GC_allow_register_threads(void);
 """)
+libgc.set_source("nix._nix_api_gc", '''
+    #define GC_THREADS
+    #include <gc/gc.h>
+    ''',
+                 libraries=gc_parsed["libraries"],
+                 library_dirs=gc_parsed["library_dirs"],
+                 include_dirs=gc_parsed["include_dirs"])
 
 
 # Compile the CFFI extension
@@ -57,3 +152,4 @@ if __name__ == '__main__':
     libutil.compile(verbose=True)
     libstore.compile(verbose=True)
     libexpr.compile(verbose=True)
+    libgc.compile(verbose=True)
@@ -4,7 +4,7 @@ from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from .expr import Value
 
-__all__ = ["util", "store", "expr", "eval"]
+__all__ = ["util", "store", "expr", "derivation", "gc", "index", "aio", "flake", "trace", "watch", "serialize", "eval"]
 
 _state = None
 _store = None
@@ -0,0 +1,3 @@
+from ._nix_api_types import ffi, lib
+
+__all__ = ["ffi", "lib"]
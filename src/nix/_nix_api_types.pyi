@@ -5,6 +5,8 @@ class CData:
         pass
     def __getitem__(self, i: int) -> Any:
         pass
+    def __int__(self) -> int:
+        pass
 
 R = TypeVar("R")
 
@@ -29,6 +31,8 @@ class ffi:
     def new_handle(cls, x: Any) -> CData: ...
     @classmethod
     def cast(cls, t: str, x: Any) -> CData: ...
+    @classmethod
+    def buffer(cls, x: CData, size: int = ...) -> Any: ...
 
 class Lib:
     def __getattribute__(self, name: str) -> Any: ...
@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import asyncio
+import queue
+import threading
+import typing
+import weakref
+from collections.abc import Callable
+from dataclasses import dataclass
+from typing import Any, Optional, TypeVar
+
+from . import gc
+from .util import CancellationToken, interruptible
+
+__all__ = ["Evaluator"]
+
+R = TypeVar("R")
+
+
+@dataclass
+class _Job:
+    func: Callable[..., Any]
+    args: tuple[Any, ...]
+    kwargs: dict[str, Any]
+    token: CancellationToken
+    future: asyncio.Future[Any]
+    loop: asyncio.AbstractEventLoop
+
+
+def _set_result(fut: asyncio.Future[Any], result: Any) -> None:
+    if not fut.done():
+        fut.set_result(result)
+
+
+def _set_exception(fut: asyncio.Future[Any], exc: BaseException) -> None:
+    if not fut.done():
+        fut.set_exception(exc)
+
+
+class Evaluator:
+    """ Runs the evaluations of one State on a dedicated thread, for use from asyncio.
+
+    Jobs run one at a time, in submission order. At most `max_pending` jobs per event loop
+    are queued or running; further submissions wait without blocking the event loop.
+    Cancelling the awaiting task interrupts its evaluation. Nix can interrupt a thread only once,
+    so after that the evaluator continues on a fresh thread.
+
+    Each job runs while holding `lock`. Nix States are not thread-safe, so code that uses
+    the same State synchronously from other threads, including the event loop, must hold the same lock.
+    Accessing values with v["x"], keys() or iteration evaluates them too; from async code
+    use the async accessors of Value (select_async, keys_async, elements_async) instead.
+    """
+    def __init__(self, max_pending: int = 64, lock: Optional[threading.RLock] = None) -> None:
+        """
+        :param max_pending: Maximum number of queued and running jobs
+        :param lock: The lock of the State the jobs evaluate in
+        """
+        self.max_pending = max_pending
+        self._lock = threading.RLock() if lock is None else lock
+        # must happen on a registered thread, like the one creating the evaluator
+        gc.allow_register_threads()
+        self._slots: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore] = (
+            weakref.WeakKeyDictionary()
+        )
+        self._slots_lock = threading.Lock()
+        self._queue: queue.SimpleQueue[Optional[_Job]] = queue.SimpleQueue()
+        self._start()
+
+    async def run(self, func: Callable[..., R], *args: Any, **kwargs: Any) -> R:
+        """ Run `func(*args, **kwargs, cancel=token)` on the evaluator thread and wait for the result """
+        loop = asyncio.get_running_loop()
+        # asyncio semaphores belong to the loop that first waits on them
+        with self._slots_lock:
+            slots = self._slots.get(loop)
+            if slots is None:
+                slots = self._slots[loop] = asyncio.Semaphore(self.max_pending)
+        async with slots:
+            job = _Job(func, args, kwargs, CancellationToken(), loop.create_future(), loop)
+            self._queue.put(job)
+            try:
+                return typing.cast(R, await job.future)
+            except asyncio.CancelledError:
+                job.token.cancel()
+                raise
+
+    def close(self) -> None:
+        """ Stop the evaluator thread after the queued jobs """
+        self._queue.put(None)
+
+    def _start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="nix-evaluator", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        # so that Boehm scans this thread's stack, and may collect from it
+        with gc.registered_thread():
+            while True:
+                job = self._queue.get()
+                if job is None:
+                    return
+                if job.token.cancelled:
+                    continue
+                try:
+                    with self._lock:
+                        res = job.func(*job.args, **job.kwargs, cancel=job.token)
+                except BaseException as e:
+                    self._reply(job, _set_exception, e)
+                else:
+                    self._reply(job, _set_result, res)
+                if not interruptible():
+                    # a cancelled job used up this thread's interrupt, continue on a fresh thread
+                    self._start()
+                    return
+
+    def _reply(
+        self, job: _Job, setter: Callable[[asyncio.Future[Any], Any], None], res: Any
+    ) -> None:
+        try:
+            job.loop.call_soon_threadsafe(setter, job.future, res)
+        except RuntimeError:
+            # the event loop was closed while we were evaluating
+            pass
+
@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import dataclasses
+import functools
+import typing
+from collections.abc import Iterable
+from typing import Optional
+
+from .expr import Value, Type
+from .store import Store
+
+__all__ = ["Derivation", "InstantiateResult", "is_derivation", "instantiate_many"]
+
+
+def is_derivation(value: Value) -> bool:
+    """ Check if a value is a derivation, without instantiating it """
+    if value.force_type() != Type.attrs or "type" not in value:
+        return False
+    tp = value.get_attr_byname("type")
+    return tp.force_type() == Type.string and str(tp) == "derivation"
+
+
+class Derivation:
+    """ A view on a derivation attrset that caches the attributes it reads.
+    Only drv_path, out_path and build() instantiate the derivation (writing its .drv to the store).
+    """
+    def __init__(self, value: Value) -> None:
+        """
+        :param value: A Value that evaluates to a derivation
+        """
+        if not is_derivation(value):
+            raise TypeError("nix value is not a derivation")
+        self.value = value
+
+    @functools.cached_property
+    def name(self) -> str:
+        return str(self.value["name"])
+
+    @functools.cached_property
+    def system(self) -> str:
+        return str(self.value["system"])
+
+    @functools.cached_property
+    def outputs(self) -> list[str]:
+        if "outputs" not in self.value:
+            return ["out"]
+        return [str(x) for x in self.value["outputs"]]
+
+    @functools.cached_property
+    def drv_path(self) -> str:
+        return str(self.value["drvPath"])
+
+    @functools.cached_property
+    def out_path(self) -> str:
+        return str(self.value["outPath"])
+
+    def build(self, store: Optional[Store] = None) -> dict[str, str]:
+        """ Build the derivation, returning the paths of its outputs """
+        if store is None:
+            from . import _store
+            store = _store
+        if store is None:
+            raise RuntimeError("No known Nix store open, try passing one to .build()")
+        return store.build(self.drv_path)
+
+    def __repr__(self) -> str:
+        return f"<Nix derivation {self.name}>"
+
+
+@dataclasses.dataclass
+class InstantiateResult:
+    """ The outcome of instantiating one derivation with instantiate_many """
+    value: Value
+    derivation: Optional[Derivation] = None
+    error: Optional[Exception] = None
+
+    @property
+    def drv_path(self) -> Optional[str]:
+        """ The path of the .drv, or None if instantiating failed """
+        if self.error is not None or self.derivation is None:
+            return None
+        return self.derivation.drv_path
+
+
+def instantiate_many(values: Iterable[Value | Derivation]) -> list[InstantiateResult]:
+    """ Instantiate a batch of derivations, capturing errors per item.
+    The drvPath of every successful result is cached on its Derivation,
+    so building them afterwards doesn't evaluate it again.
+    """
+    res = []
+    for v in values:
+        if isinstance(v, Derivation):
+            item = InstantiateResult(v.value, v)
+        else:
+            item = InstantiateResult(typing.cast(Value, v))
+        try:
+            if item.derivation is None:
+                item.derivation = Derivation(item.value)
+            item.derivation.drv_path
+        except Exception as e:
+            item.error = e
+        res.append(item)
+    return res
@@ -1,26 +1,203 @@
 from __future__ import annotations
 
+import array
 import collections.abc
+import contextlib
+import dataclasses
+import time
 import typing
-from collections.abc import Callable, Iterator
+import weakref
+from collections.abc import Callable, Iterable, Iterator
 from typing import Any, TypeAlias, Union, Optional
 import enum
 import inspect
+import itertools
+import json
+import mmap
+import os
+import tempfile
+import threading
 from threading import local as thread_local
 from pathlib import PurePath
 
-from .util import settings, NixAPIError
+from .util import settings, NixAPIError, CancellationToken, Context, Ctx, watched
 from .store import Store
 from .expr_util import ffi, lib, lib_unwrapped, CData, ReferenceGC
-from .external import ExternalValue
+from .external import ExternalValue, BufferExternalValueImpl
+from . import gc
+from .aio import Evaluator
 
-__all__ = ["ExternalValue", "State", "Value", "Type", "Function", "PrimOp"]
+if typing.TYPE_CHECKING:
+    from .derivation import Derivation
+
+__all__ = [
+    "ExternalValue",
+    "State",
+    "Value",
+    "Type",
+    "Function",
+    "PrimOp",
+    "ListView",
+    "ListIterator",
+    "EvalStats",
+    "EvalResult",
+    "PrimOpCacheInfo",
+]
+
+
+@dataclasses.dataclass
+class EvalStats:
+    """ Evaluator statistics: the counters NIX_SHOW_STATS prints, heap statistics, and this library's own counters.
+
+    The Nix counters are read from the evaluator of the State, so they count all its work,
+    on any thread. Only `thunks` is shared by all States in the process.
+    The python_* counters count calls through this library in the whole process. They are
+    updated without a lock, so with several threads evaluating at once they are approximate.
+    """
+    thunks: int = 0
+    "thunks created"
+    thunks_avoided: int = 0
+    "thunks that didn't need to be created"
+    function_calls: int = 0
+    "function applications"
+    primop_calls: int = 0
+    "primop applications"
+    values: int = 0
+    "values allocated"
+    envs: int = 0
+    "environments allocated"
+    env_elements: int = 0
+    "values stored in environments"
+    attrsets: int = 0
+    "attribute sets allocated"
+    attrset_elements: int = 0
+    "attributes in the allocated attribute sets"
+    list_elements: int = 0
+    "list elements allocated"
+    list_concats: int = 0
+    "list concatenations"
+    lookups: int = 0
+    "variable lookups in with-scopes"
+    op_updates: int = 0
+    "// operations"
+    op_update_values_copied: int = 0
+    "attributes copied by // operations"
+    bytes_allocated: int = 0
+    "bytes allocated on the GC heap, by the whole process"
+    gc_collections: int = 0
+    "garbage collections"
+    python_values_allocated: int = 0
+    "values allocated from Python"
+    python_function_calls: int = 0
+    "function applications from Python"
+    python_primop_calls: int = 0
+    "calls into Python primops"
+    python_primop_cache_hits: int = 0
+    "Python primop calls answered from the cache of a pure PrimOp"
+    python_attrsets_built: int = 0
+    "attribute sets converted from Python"
+    python_lists_built: int = 0
+    "lists converted from Python"
+    python_forces: int = 0
+    "force calls from Python"
+    force_time: float = 0.0
+    "seconds spent in force calls from Python, only counted inside State.measure"
+
+    def __sub__(self, other: EvalStats) -> EvalStats:
+        return EvalStats(
+            **{
+                f.name: getattr(self, f.name) - getattr(other, f.name)
+                for f in dataclasses.fields(self)
+            }
+        )
+
+
+def _read_nix_stats(state: CData) -> dict[str, int]:
+    """ The EvalState counters, from the JSON that printStatistics() writes """
+    fd, path = tempfile.mkstemp(prefix="python-nix-stats-", suffix=".json")
+    try:
+        os.close(fd)
+        if lib_unwrapped.py_nix_state_write_stats(state, path.encode()) != 0:
+            raise NixAPIError("can't read the evaluator statistics")
+        with open(path) as f:
+            res = json.load(f)
+    finally:
+        os.unlink(path)
+    return {
+        "thunks": res["nrThunks"],
+        "thunks_avoided": res["nrAvoided"],
+        "function_calls": res["nrFunctionCalls"],
+        "primop_calls": res["nrPrimOpCalls"],
+        "values": res["values"]["number"],
+        "envs": res["envs"]["number"],
+        "env_elements": res["envs"]["elements"],
+        "attrsets": res["sets"]["number"],
+        "attrset_elements": res["sets"]["elements"],
+        "list_elements": res["list"]["elements"],
+        "list_concats": res["list"]["concats"],
+        "lookups": res["nrLookups"],
+        "op_updates": res["nrOpUpdates"],
+        "op_update_values_copied": res["nrOpUpdateValuesCopied"],
+    }
+
+
+_counters = EvalStats()
+# the number of active State.measure blocks; forces are only timed while there are any
+_timing = 0
+
+
+@dataclasses.dataclass
+class EvalResult:
+    """ The outcome of evaluating one expression with State.eval_many """
+    expr: str
+    value: Optional[Value] = None
+    error: Optional[Exception] = None
+    parse_time: float = 0.0
+    "seconds spent parsing, or looking up the cached parse"
+    eval_time: float = 0.0
+    "seconds spent evaluating to weak head normal form"
+    cached: bool = False
+    "whether the parsed expression came from the cache"
+
+
+@dataclasses.dataclass(frozen=True)
+class PrimOpCacheInfo:
+    """ Cache statistics of a pure PrimOp """
+    hits: int
+    misses: int
+    maxsize: Optional[int]
+    currsize: int
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+def _address(ptr: CData) -> int:
+    return int(ffi.cast("uintptr_t", ptr))
+
+
+# so that Values, which only have the State* pointer, can find their State
+_states: weakref.WeakValueDictionary[int, State] = weakref.WeakValueDictionary()
 
 
 class State:
     """ A Nix interpreter State """
-    def __init__(self, search_path: list[str], store_wrapper: Store) -> None:
+    def __init__(
+        self,
+        search_path: list[str],
+        store_wrapper: Store,
+        parse_cache_size: int = 128,
+    ) -> None:
+        """
+        :param search_path: Entries to add to the Nix search path
+        :param store_wrapper: The Store to evaluate against
+        :param parse_cache_size: Number of parsed expressions to keep for eval_string(cache=True) and eval_many
+        """
         ffi.init_once(lib.nix_libexpr_init, "init_libexpr")
+        # evaluations with a timeout, and the evaluator thread, run on threads registered with the GC
+        gc.allow_register_threads()
         search_path_c = [ffi.new("char[]", path.encode()) for path in search_path]
         search_path_c.append(ffi.NULL)
         search_path_ptr = ffi.new("char*[]", search_path_c)
@@ -28,23 +205,163 @@ class State:
             lib.nix_state_create(search_path_ptr, store_wrapper._store),
             lib.nix_state_free,
         )
+        self._evaluator: Optional[Evaluator] = None
+        self.lock = threading.RLock()
+        "held by the evaluator thread while it evaluates, see evaluator()"
+        self.parse_cache_size = parse_cache_size
+        self._builtins: dict[str, Value] = {}
+        self._parse_cache: collections.OrderedDict[tuple[str, str], Value] = collections.OrderedDict()
+        _states[_address(self._state)] = self
+
+    @classmethod
+    def from_ptr(cls, state_ptr: CData) -> State:
+        """ Find the State object for a State* pointer """
+        return _states[_address(state_ptr)]
 
-    def eval_string(self, expr_string: str, path: str) -> Value:
-        """ Evaluate a Nix expression string into a Value """
+    def evaluator(self, max_pending: int = 64) -> Evaluator:
+        """ The thread that runs the async evaluations of this State, started on first use
+        and stopped when the State is freed.
+
+        Once it is started, hold State.lock while using this State from other threads,
+        the evaluator thread holds it while evaluating. That includes the event loop:
+        use the async accessors (Value.select_async, keys_async, elements_async) rather than v["x"],
+        keys() or iteration, which evaluate too.
+
+        :param max_pending: Maximum number of queued async evaluations, used when starting the thread
+        """
+        if self._evaluator is None:
+            self._evaluator = Evaluator(max_pending, self.lock)
+            weakref.finalize(self, self._evaluator.close)
+        return self._evaluator
+
+    async def eval_async(
+        self, expr_string: str, path: str = ".", timeout: Optional[float] = None
+    ) -> Value:
+        """ Evaluate a Nix expression string on the evaluator thread """
+        return await self.evaluator().run(self.eval_string, expr_string, path, timeout=timeout)
+
+    def eval_string(
+        self,
+        expr_string: str,
+        path: str,
+        timeout: Optional[float] = None,
+        cancel: Optional[CancellationToken] = None,
+        cache: bool = False,
+    ) -> Value:
+        """ Evaluate a Nix expression string into a Value
+
+        :param timeout: Raise EvaluationTimeout if evaluation takes longer than this many seconds
+        :param cancel: Raise EvaluationCancelled when this token is cancelled
+        :param cache: Keep the parsed expression, so evaluating the same string again skips parsing
+        """
+        if cache:
+            return self._parse(expr_string, path)(None, timeout=timeout, cancel=cancel)
         val = self.alloc_val()
-        expr = lib.nix_expr_eval_from_string(
-            self._state, expr_string.encode(), path.encode(), val._value
+        watched(
+            timeout, cancel,
+            lib.nix_expr_eval_from_string,
+            self._state, expr_string.encode(), path.encode(), val._value,
         )
         return val
 
+    def builtin(self, name: str) -> Value:
+        """ Look up builtins.<name>, cached per State """
+        res = self._builtins.get(name)
+        if res is None:
+            res = self._builtins[name] = self.eval_string("builtins." + name, ".")
+        return res
+
+    def _parse(self, expr_string: str, path: str) -> Value:
+        """ Parse an expression into a function that evaluates it when applied to anything.
+        The result is kept in an LRU cache keyed by (expression, path).
+        """
+        key = (expr_string, path)
+        res = self._parse_cache.get(key)
+        if res is not None:
+            self._parse_cache.move_to_end(key)
+            return res
+        # evaluating a lambda only parses its body.
+        # the body starts on the first line, so line numbers in errors stay correct.
+        # the argument name must not shadow anything the expression refers to
+        res = self.eval_string("__pythonNixParseArg: (" + expr_string + "\n)", path)
+        if self.parse_cache_size > 0:
+            self._parse_cache[key] = res
+            if len(self._parse_cache) > self.parse_cache_size:
+                self._parse_cache.popitem(last=False)
+        return res
+
+    def eval_many(self, exprs: Iterable[str], path: str = ".") -> list[EvalResult]:
+        """ Evaluate a batch of expressions using the parse cache.
+        Errors are captured per expression instead of raised.
+        """
+        res = []
+        for expr_string in exprs:
+            item = EvalResult(expr_string, cached=(expr_string, path) in self._parse_cache)
+            start = time.perf_counter()
+            try:
+                fn = self._parse(expr_string, path)
+                parsed = time.perf_counter()
+                item.parse_time = parsed - start
+                item.value = fn(None)
+                item.eval_time = time.perf_counter() - parsed
+            except Exception as e:
+                item.error = e
+            res.append(item)
+        return res
+
+    def loads(self, buf: bytes | bytearray | memoryview | mmap.mmap) -> Value:
+        """ Load a value serialized with Value.dumps into this State """
+        from .serialize import loads
+        return loads(self, buf)
+
+    def load(self, path: str | os.PathLike[str]) -> Value:
+        """ Load a file written from Value.dumps, memory-mapping it """
+        from .serialize import load
+        return load(self, path)
+
+    def stats(self) -> EvalStats:
+        """ A snapshot of the evaluator statistics. Nix only writes them to a file, which takes about a millisecond. """
+        heap = gc.stats()
+        return dataclasses.replace(
+            _counters,
+            **_read_nix_stats(self._state),
+            bytes_allocated=heap.total_bytes,
+            gc_collections=heap.collections,
+        )
+
+    @contextlib.contextmanager
+    def measure(self) -> Iterator[EvalStats]:
+        """ Measure the evaluator counters for the enclosed work.
+        The yielded EvalStats is filled in when the block exits.
+        It includes whatever other threads evaluate in this State meanwhile, see EvalStats. ::
+
+            with state.measure() as m:
+                state.eval_string("import <nixpkgs> {}", ".").force(deep=True)
+            print(m.thunks, m.function_calls, m.bytes_allocated)
+        """
+        global _timing
+        res = EvalStats()
+        _timing += 1
+        start = self.stats()
+        try:
+            yield res
+        finally:
+            delta = self.stats() - start
+            _timing -= 1
+            for f in dataclasses.fields(res):
+                setattr(res, f.name, getattr(delta, f.name))
+
     def alloc_val(self) -> Value:
         """ Allocate an empty Value. Will crash when accessing without setting a value """
         return Value(self._state)
 
-    def val_from_python(self, py_val: Evaluated) -> Value:
-        """ Create a Nix value from a Python value """
+    def val_from_python(self, py_val: Evaluated, lazy: bool = False) -> Value:
+        """ Create a Nix value from a Python value
+
+        :param lazy: Convert the contents of containers only when Nix forces them, see Value.set
+        """
         v = self.alloc_val()
-        v.set(py_val)
+        v.set(py_val, lazy=lazy)
         return v
 
 
@@ -58,6 +375,8 @@ Evaluated: TypeAlias = Union[
     PurePath,
     "Function",  # | String
     "ExternalValue",
+    bytes,
+    memoryview,
 ]
 DeepEvaluated = Union[
     int,
@@ -69,6 +388,8 @@ DeepEvaluated = Union[
     PurePath,
     "Function",
     "ExternalValue",
+    bytes,
+    memoryview,
     # string
 ]
 
@@ -108,19 +429,17 @@ class Function:
     def __repr__(self) -> str:
         return repr(self.value)
 
-    def __call__(self, arg: Value | Evaluated) -> Value:
-        if not isinstance(arg, Value):
-            arg2 = Value(self.value._state)
-            arg2.set(arg)
-            arg = arg2
-        res = Value(self.value._state)
-        lib.nix_value_call(
-            self.value._state,
-            self.value._value,
-            arg._value,
-            res._value,
-        )
-        return res
+    def __call__(
+        self,
+        arg: Value | Evaluated | Callable[..., Any],
+        timeout: Optional[float] = None,
+        cancel: Optional[CancellationToken] = None,
+    ) -> Value:
+        return self.value(arg, timeout=timeout, cancel=cancel)
+
+    async def call_async(self, arg: Value | Evaluated, timeout: Optional[float] = None) -> Value:
+        """ Call the function on the evaluator thread of its State """
+        return await self.value.call_async(arg, timeout=timeout)
 
 
 T = typing.TypeVar("T")
@@ -129,6 +448,7 @@ T = typing.TypeVar("T")
 # all primops use this code. first argument is secretly the primop handle
 @ffi.def_extern()
 def py_nix_primop_base(user_data: CData, c_ctx: CData, st: CData, args: CData, ret: CData) -> None:
+    _counters.python_primop_calls += 1
     result = Value(st, ret, make_reference=True)
     PrimOp.calling_state.state = st
     try:
@@ -137,8 +457,20 @@ def py_nix_primop_base(user_data: CData, c_ctx: CData, st: CData, args: CData, r
         argv = []
         for i in range(op.arity):
             argv.append(Value(st, args[i], make_reference=True))
-        res = op.func(*argv)
-        result.set(res)
+        if not op.pure:
+            result.set(op.func(*argv), lazy=op.lazy)
+            return
+        # ret and args may point into the evaluator's stack frame,
+        # so the cache only keeps copies on the GC heap
+        key = (_address(st), tuple(_heap_copy(st, arg) for arg in argv))
+        cached = op._cache_get(key)
+        if cached is None:
+            cached = Value(st)
+            cached.set(op.func(*argv), lazy=op.lazy)
+            op._cache_put(key, cached)
+        else:
+            _counters.python_primop_cache_hits += 1
+        lib.nix_copy_value(ret, cached._value)
     except Exception as e:
         print("Error in callback")
         print(e)
@@ -148,6 +480,14 @@ def py_nix_primop_base(user_data: CData, c_ctx: CData, st: CData, args: CData, r
         PrimOp.calling_state.state = None
 
 
+def _heap_copy(st: CData, v: Value) -> Value:
+    """ A copy of a forced value in a newly allocated Value """
+    v.force_type()
+    res = Value(st)
+    lib.nix_copy_value(res._value, v._value)
+    return res
+
+
 class PrimOp(ReferenceGC):
     func: Callable[..., Evaluated | Value]
     arity: int
@@ -158,11 +498,24 @@ class PrimOp(ReferenceGC):
     calling_state = thread_local()
     "while inside a primop callback, this contains the interpreter State* pointer at PrimOp.calling_state.state"
 
-    def __init__(self, cb: Callable[..., Evaluated | Value]) -> None:
+    def __init__(
+        self,
+        cb: Callable[..., Evaluated | Value],
+        pure: bool = False,
+        cache_size: Optional[int] = 128,
+        lazy: bool = False,
+    ) -> None:
+        """
+        :param cb: The Python function to call, with one Value per argument
+        :param pure: Memoize results by the structure of the arguments, which forces them deeply.
+            Repeated calls copy the cached Nix value instead of calling `cb` again.
+        :param cache_size: Number of results to keep for pure primops, None for no limit
+        :param lazy: Convert the results of `cb` lazily, see Value.set
+        """
         ffi.init_once(lib.nix_libexpr_init, "init_libexpr")
 
-        args, varargs, varkw, defaults = inspect.getargspec(cb)
-        if varargs is not None or varkw is not None or defaults is not None:
+        args, varargs, varkw, defaults, kwonlyargs, _, _ = inspect.getfullargspec(cb)
+        if varargs is not None or varkw is not None or defaults is not None or kwonlyargs:
             raise TypeError("only simple methods can be primops now")
         arity = len(args)
         argnames_c = [ffi.new("char[]", path.encode()) for path in args]
@@ -178,6 +531,12 @@ class PrimOp(ReferenceGC):
 
         self.func = cb
         self.arity = arity
+        self.pure = pure
+        self.lazy = lazy
+        self.cache_size = cache_size
+        self._cache: collections.OrderedDict[tuple[int, tuple[Value, ...]], Value] = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
         self.handle = ffi.new_handle(self)
         self._primop = lib.nix_alloc_primop(
             lib_unwrapped.py_nix_primop_base,
@@ -192,6 +551,27 @@ class PrimOp(ReferenceGC):
     def unref(self) -> None:
         lib.nix_gc_decref(self._primop)
 
+    def cache_info(self) -> PrimOpCacheInfo:
+        return PrimOpCacheInfo(self._hits, self._misses, self.cache_size, len(self._cache))
+
+    def cache_clear(self) -> None:
+        self._cache.clear()
+        self._hits = self._misses = 0
+
+    def _cache_get(self, key: tuple[int, tuple[Value, ...]]) -> Optional[Value]:
+        res = self._cache.get(key)
+        if res is None:
+            self._misses += 1
+            return None
+        self._hits += 1
+        self._cache.move_to_end(key)
+        return res
+
+    def _cache_put(self, key: tuple[int, tuple[Value, ...]], result: Value) -> None:
+        self._cache[key] = result
+        if self.cache_size is not None and len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
 class Value:
     """ A Nix Value """
     def __init__(
@@ -201,7 +581,9 @@ class Value:
         make_reference: bool = False,
     ) -> None:
         self._state = state_ptr
+        self._hash: Optional[int] = None
         if value_ptr is None:
+            _counters.python_values_allocated += 1
             self._value = lib.nix_alloc_value(state_ptr)
         else:
             self._value = value_ptr
@@ -223,9 +605,13 @@ class Value:
     def __repr__(self) -> str:
         t = self.get_type()
         if t == Type.attrs and "type" in self and self["type"].force() == "derivation":
-            return "<Nix derivation {}>".format(self["drvPath"].force())
+            # the name, as the drvPath would instantiate the derivation
+            return "<Nix derivation {}>".format(str(self["name"]))
         elif t not in {Type.thunk, Type.function, Type.attrs}:
-            return f"<Nix: {self.force()}>"
+            res = self.force()
+            if isinstance(res, (bytes, memoryview)):
+                return f"<Nix: {bytes(res)!r}>"
+            return f"<Nix: {res}>"
         else:
             return f"<Nix Value ({self.get_typename()})>"
 
@@ -249,7 +635,7 @@ class Value:
                     self.get_attr_iterate(lambda k, v: res_dict.__setitem__(k, v))
                 return res_dict
             case Type.list:
-                res_list: list[Value] = list(self)
+                res_list: list[Value] = list(self.iter_list())
                 if deep:
                     # todo don't need another force call
                     return [x._to_python(deep=True) for x in res_list]
@@ -261,25 +647,82 @@ class Value:
                     ffi.string(lib.nix_get_path_string(self._value)).decode()
                 )
             case Type.external:
-                ev = lib.nix_get_external(self._value)
-                handle = lib.nix_get_external_value_content(ev)
-                if handle == ffi.NULL:
-                    raise RuntimeError("Unknown external value")
-                return ExternalValue.from_handle(handle)
+                ext = self._get_external()
+                if ext.passthrough:
+                    return ext.value
+                return ext
             case Type.null:
                 return None
             case _:
                 raise NotImplementedError("can't convert", self.get_type())
 
+    def _get_external(self) -> ExternalValue:
+        ev = lib.nix_get_external(self._value)
+        handle = lib.nix_get_external_value_content(ev)
+        if handle == ffi.NULL:
+            raise RuntimeError("Unknown external value")
+        return ExternalValue.from_handle(handle)
+
     # https://github.com/python/mypy/issues/9773
-    def force(self, typeCheck: Any = evaluated_types, deep: bool = False) -> Evaluated:
-        self.force_type(typeCheck, deep=deep)
+    def force(
+        self,
+        typeCheck: Any = evaluated_types,
+        deep: bool = False,
+        timeout: Optional[float] = None,
+        cancel: Optional[CancellationToken] = None,
+    ) -> Evaluated:
+        self.force_type(typeCheck, deep=deep, timeout=timeout, cancel=cancel)
         return self._to_python(deep)
 
+    async def force_async(
+        self,
+        typeCheck: Any = evaluated_types,
+        deep: bool = False,
+        timeout: Optional[float] = None,
+    ) -> Evaluated:
+        """ Force the value on the evaluator thread of its State """
+        evaluator = State.from_ptr(self._state).evaluator()
+        return await evaluator.run(self.force, typeCheck, deep, timeout=timeout)
+
+    async def select_async(self, path: str | Iterable[str], timeout: Optional[float] = None) -> Value:
+        """ Select a nested attribute on the evaluator thread of its State, like v["a"]["b"]
+
+        :param path: Attribute names, or a string of dot-separated names
+        """
+        evaluator = State.from_ptr(self._state).evaluator()
+        return await evaluator.run(_select, self, _attr_path(path), timeout=timeout)
+
+    async def keys_async(self, timeout: Optional[float] = None) -> list[str]:
+        """ The attribute names, evaluated on the evaluator thread of its State """
+        evaluator = State.from_ptr(self._state).evaluator()
+        return await evaluator.run(_keys, self, timeout=timeout)
+
+    async def elements_async(self, timeout: Optional[float] = None) -> list[Value]:
+        """ The list elements, evaluated on the evaluator thread of its State """
+        evaluator = State.from_ptr(self._state).evaluator()
+        return await evaluator.run(_elements, self, timeout=timeout)
+
     def force_type(
-        self, typeCheck: set[Type] | Type = evaluated_types, deep: bool = False
+        self,
+        typeCheck: set[Type] | Type = evaluated_types,
+        deep: bool = False,
+        timeout: Optional[float] = None,
+        cancel: Optional[CancellationToken] = None,
     ) -> Type:
-        self._force(deep=deep)
+        """ Force the value and check that its type is in `typeCheck`
+
+        :param timeout: Raise EvaluationTimeout if evaluation takes longer than this many seconds
+        :param cancel: Raise EvaluationCancelled when this token is cancelled
+        """
+        _counters.python_forces += 1
+        if _timing:
+            start = time.perf_counter()
+            try:
+                watched(timeout, cancel, self._force, deep=deep)
+            finally:
+                _counters.force_time += time.perf_counter() - start
+        else:
+            watched(timeout, cancel, self._force, deep=deep)
         tp = self.get_type()
         if not isinstance(typeCheck, set):
             typeCheck = {typeCheck}
@@ -311,12 +754,18 @@ class Value:
             name = ffi.string(name_ptr[0]).decode()
             iter_func(name, val)
 
+    def iter_list(self, prefetch: int = 1) -> ListIterator:
+        """ Iterate over the elements of a list, forcing it only once
+
+        :param prefetch: Wrap elements in batches of this size, amortizing the per-element overhead for long lists
+        """
+        self.force_type(Type.list)
+        return ListIterator(self, range(int(lib.nix_get_list_size(self._value))), prefetch)
+
     def __iter__(self) -> typing.Any:
         match self.force_type({Type.attrs, Type.list}):
             case Type.list:
-                return collections.abc.Sequence.__iter__(
-                    typing.cast(collections.abc.Sequence[Value], self)
-                )
+                return ListIterator(self, range(int(lib.nix_get_list_size(self._value))))
             case Type.attrs:
                 return iter(typing.cast(dict[str, Evaluated], self.force()))
 
@@ -357,7 +806,7 @@ class Value:
             case _:
                 raise RuntimeError
 
-    def __contains__(self, i: int | str) -> bool:
+    def __contains__(self, i: Value | Evaluated) -> bool:
         match self.force_type({Type.attrs, Type.list}):
             case Type.attrs:
                 assert type(i) == str
@@ -365,25 +814,235 @@ class Value:
                     lib.nix_has_attr_byname(self._value, self._state, i.encode())
                 )
             case Type.list:
-                return i in list(self)
+                return any(elem == i for elem in self.iter_list())
             case _:
                 raise RuntimeError
 
+    def __eq__(self, other: object) -> bool:
+        """ Structural equality, following the semantics of Nix's == operator.
+        Values backed by the same pointer are equal without being forced.
+        Derivations are compared by outPath, as in Nix. Like drvPath, outPath comes from
+        derivationStrict, so comparing derivations instantiates them, writing their .drv files.
+        """
+        if isinstance(other, Value):
+            return _values_equal(self, other)
+        match self.force_type():
+            case Type.attrs | Type.list:
+                if not isinstance(other, (dict, list)):
+                    return False
+                return bool(self.force(deep=True) == other)
+            case Type.function | Type.external:
+                return False
+            case _:
+                return bool(self._to_python() == other)
+
+    def __hash__(self) -> int:
+        """ Content hash consistent with ==. Computed once per Value, so this forces the value deeply.
+        Derivations hash by outPath, which instantiates them.
+        """
+        if self._hash is None:
+            self._hash = _value_hash(self)
+        return self._hash
+
+    def _derivation_out_path(self) -> Optional[str]:
+        """ The outPath of a forced attrset if it is a derivation, otherwise None """
+        if not lib.nix_has_attr_byname(self._value, self._state, b"type"):
+            return None
+        tp = self.get_attr_byname("type")
+        if tp.force_type() != Type.string or tp._to_python() != "derivation":
+            return None
+        return str(self.get_attr_byname("outPath"))
+
+    @typing.overload
+    def __getitem__(self, i: slice) -> ListView:
+        ...
+
+    @typing.overload
     def __getitem__(self, i: int | str) -> Value:
+        ...
+
+    def __getitem__(self, i: int | str | slice) -> Value | ListView:
         match self.force_type({Type.attrs, Type.list}):
             case Type.attrs:
                 if not isinstance(i, str):
                     raise TypeError("key should be a string")
                 return self.get_attr_byname(i)
             case Type.list:
+                size = int(lib.nix_get_list_size(self._value))
+                if isinstance(i, slice):
+                    return ListView(self, range(size)[i])
                 if not isinstance(i, int):
                     raise TypeError("key should be a integer")
-                if i >= len(self):
+                if i < 0:
+                    i += size
+                if not 0 <= i < size:
                     raise IndexError("list index out of range")
-                return self.get_list_byidx(i % len(self))
+                return self.get_list_byidx(i)
             case _:
                 raise RuntimeError
 
+    def type_if_forced(self) -> Optional[Type]:
+        """ The type of this value, or None if it is still a thunk. Never evaluates anything. """
+        tp = lib.nix_get_type(self._value)
+        return None if tp == lib.NIX_TYPE_THUNK else Type(tp)
+
+    def get(self, name: str, default: Any = None) -> Value | Any:
+        """ The attribute `name`, or `default` if this is not an attribute set or has no such attribute.
+
+        Misses cost one FFI call and don't build exceptions, which makes this the cheap way
+        to probe values in tree walks. Errors while evaluating this value or the attribute still raise.
+        """
+        if self._forced_type() != lib.NIX_TYPE_ATTRS:
+            return default
+        with Ctx() as ctx:
+            value_ptr = lib_unwrapped.nix_get_attr_byname(ctx._ctx, self._value, self._state, name.encode())
+            err = ctx.nix_err_code()
+            if err == lib.NIX_ERR_KEY:
+                return default
+            ctx._err_check(err)
+        return Value(self._state, value_ptr)
+
+    def try_select(self, path: str | Iterable[str], default: Any = None) -> Value | Any:
+        """ Select a nested attribute, like `v.a.b or default` in Nix
+
+        :param path: Attribute names, or a string of dot-separated names
+        """
+        v: Value = self
+        for name in _attr_path(path):
+            found = v.get(name, _missing)
+            if found is _missing:
+                return default
+            v = found
+        return v
+
+    def has_path(self, path: str | Iterable[str]) -> bool:
+        """ Whether a nested attribute exists, like `v ? a.b` in Nix. The last attribute isn't evaluated. """
+        names = _attr_path(path)
+        if not names:
+            return True
+        parent = self.try_select(names[:-1], _missing)
+        if parent is _missing or parent._forced_type() != lib.NIX_TYPE_ATTRS:
+            return False
+        return bool(lib.nix_has_attr_byname(parent._value, parent._state, names[-1].encode()))
+
+    def _forced_type(self) -> int:
+        tp = lib.nix_get_type(self._value)
+        if tp == lib.NIX_TYPE_THUNK:
+            self.force_type()
+            tp = lib.nix_get_type(self._value)
+        return int(tp)
+
+    def to_array(self, typecode: str = "q") -> array.array:
+        """ Force a list of numbers into an array.array in one pass
+
+        Integer typecodes accept Nix integers, the floating point typecodes ("f" and "d")
+        accept both integers and floats. The result supports the buffer protocol,
+        so ``memoryview(v.to_array("d"))`` gives typed access without further copies.
+
+        :param typecode: An array module typecode
+        """
+        res = array.array(typecode)
+        floating = typecode in {"f", "d"}
+        self.force_type(Type.list)
+        size = int(lib.nix_get_list_size(self._value))
+        # look the wrapped functions up once instead of once per element
+        get_list_byidx = lib.nix_get_list_byidx
+        value_force = lib.nix_value_force
+        get_type = lib.nix_get_type
+        get_int = lib.nix_get_int
+        get_float = lib.nix_get_float
+        gc_decref = lib.nix_gc_decref
+        append = res.append
+        for i in range(size):
+            elem = get_list_byidx(self._value, self._state, i)
+            try:
+                value_force(self._state, elem)
+                tp = get_type(elem)
+                if tp == lib.NIX_TYPE_INT:
+                    append(get_int(elem))
+                elif tp == lib.NIX_TYPE_FLOAT and floating:
+                    append(get_float(elem))
+                else:
+                    typename = ffi.string(lib.nix_get_typename(elem)).decode()
+                    raise TypeError(
+                        f"list element {i} is {typename}, which can't be stored in an array of type '{typecode}'"
+                    )
+            finally:
+                gc_decref(elem)
+        return res
+
+    def columns(
+        self,
+        fields: Iterable[str],
+        missing: Any = None,
+        arrays: bool = False,
+    ) -> dict[str, list[Any] | array.array]:
+        """ Extract fields from a list (or attribute set) of attribute sets into columns, in one pass
+
+        Scalars become Python values, other cells are Values. Cells whose path doesn't exist
+        hold `missing`, and cells that fail to evaluate hold the exception instead of raising.
+        The rows of an attribute set are its attribute values, in keys() order.
+
+        :param fields: Attribute names or dotted paths, like "meta.license.spdxId"
+        :param missing: The value of cells whose attribute path doesn't exist
+        :param arrays: Return numeric columns without missing or failed cells as array.array ("q" for integers, "d" if there are floats)
+        """
+        paths = {f: [name.encode() for name in f.split(".")] for f in fields}
+        res: dict[str, list[Any]] = {f: [] for f in paths}
+        state = self._state
+        is_list = self.force_type({Type.list, Type.attrs}) == Type.list
+        size = len(self)
+        name_ptr = ffi.new("char**")
+        with Ctx() as ctx:
+            c = ctx._ctx
+            for i in range(size):
+                if is_list:
+                    row = lib_unwrapped.nix_get_list_byidx(c, self._value, state, i)
+                else:
+                    row = lib_unwrapped.nix_get_attr_byidx(c, self._value, state, i, name_ptr)
+                err = ctx.nix_err_code()
+                if err != lib.NIX_OK:
+                    exc = _captured(ctx, err)
+                    for col in res.values():
+                        col.append(exc)
+                    continue
+                try:
+                    for f, path in paths.items():
+                        res[f].append(_cell(ctx, state, row, path, missing))
+                finally:
+                    lib_unwrapped.nix_gc_decref(c, row)
+        if not arrays:
+            return dict(res)
+        return {f: _as_array(col) for f, col in res.items()}
+
+    def as_bytes(self) -> memoryview:
+        """ A read-only view on the bytes of a string, without copying or decoding it.
+        The view points into the Nix heap and is only valid while this Value is alive.
+        """
+        self.force_type(Type.string)
+        ptr = lib.nix_get_string(self._value)
+        return memoryview(ffi.buffer(ptr, lib_unwrapped.strlen(ptr))).toreadonly()
+
+    def write_to(self, fileobj: typing.BinaryIO) -> int:
+        """ Write a string to a binary file object without copying it first, returning the number of bytes written """
+        view = self.as_bytes()
+        fileobj.write(view)
+        return len(view)
+
+    def string_context(self) -> dict[str, dict[str, Any]]:
+        """ The context of a string, as returned by builtins.getContext:
+        the store paths it refers to, with whether it depends on the path itself,
+        on all outputs of a derivation, or on some outputs.
+        """
+        self.force_type(Type.string)
+        get_context = State.from_ptr(self._state).builtin("getContext")
+        return typing.cast(dict[str, dict[str, Any]], get_context(self).force(deep=True))
+
+    def dumps(self) -> bytes:
+        """ Serialize this value in the compact binary format of nix.serialize, forcing it deeply """
+        from .serialize import dumps
+        return dumps(self)
+
     def keys(self) -> Iterator[str]:
         self.force_type(Type.attrs)
         for i in range(len(self)):
@@ -395,18 +1054,33 @@ class Value:
             store = _store
         if store is None:
             raise RuntimeError("No known Nix store open, try passing one to .build()")
-        self.force_type(Type.attrs)
-        if "type" in self and self["type"].force() == "derivation":
-            return store.build(str(self["drvPath"]))
-        raise TypeError("nix value is not a derivation")
+        return self.as_derivation().build(store)
+
+    def as_derivation(self) -> Derivation:
+        """ A Derivation view on this value, which caches name, outputs, drvPath etc. """
+        from .derivation import Derivation
+        return Derivation(self)
+
+    def __call__(
+        self,
+        arg: Value | Evaluated | Callable[..., Any],
+        timeout: Optional[float] = None,
+        cancel: Optional[CancellationToken] = None,
+    ) -> Value:
+        """ Apply this function to `arg`
 
-    def __call__(self, arg: Value | Evaluated) -> Value:
+        :param timeout: Raise EvaluationTimeout if evaluation takes longer than this many seconds
+        :param cancel: Raise EvaluationCancelled when this token is cancelled
+        """
         if not isinstance(arg, Value):
             arg2 = Value(self._state)
             arg2.set(arg)
             arg = arg2
         res = Value(self._state)
-        lib.nix_value_call(
+        _counters.python_function_calls += 1
+        watched(
+            timeout, cancel,
+            lib.nix_value_call,
             self._state,
             self._value,
             arg._value,
@@ -414,7 +1088,20 @@ class Value:
         )
         return res
 
-    def set(self, py_val: Value | DeepEvaluated) -> None:
+    async def call_async(self, arg: Value | Evaluated, timeout: Optional[float] = None) -> Value:
+        """ Call the function on the evaluator thread of its State """
+        evaluator = State.from_ptr(self._state).evaluator()
+        return await evaluator.run(self, arg, timeout=timeout)
+
+    def set(self, py_val: Value | DeepEvaluated | Callable[..., Any], lazy: bool = False) -> None:
+        """ Set this value from a Python value
+
+        :param lazy: Convert mappings, sequences and iterators to attribute sets and lists
+            whose elements are thunks, which convert their Python source only when forced.
+            Iterators are consumed right away, but their items are converted lazily.
+            Functions convert their results lazily too.
+        """
+        self._hash = None
         if isinstance(py_val, Function):
             raise NotImplementedError
         elif isinstance(py_val, Value):
@@ -433,13 +1120,22 @@ class Value:
             lib.nix_set_null(self._value)
         elif isinstance(py_val, ExternalValue):
             lib.nix_set_external(self._value, py_val._ref)
+        elif isinstance(py_val, (bytes, bytearray, memoryview, mmap.mmap)):
+            ext = ExternalValue(py_val, constructor=BufferExternalValueImpl)
+            lib.nix_set_external(self._value, ext._ref)
+        elif lazy and isinstance(py_val, (collections.abc.Mapping, collections.abc.Sequence, collections.abc.Iterator)):
+            _set_lazy(self, py_val)
+        elif isinstance(py_val, collections.abc.Iterator):
+            self.set(list(py_val))
         elif isinstance(py_val, list):
+            _counters.python_lists_built += 1
             lib.nix_make_list(self._state, self._value, len(py_val))
             for i in range(len(py_val)):
                 v = Value(self._state)
                 v.set(py_val[i])
                 lib.nix_set_list_byidx(self._value, i, v._value)
         elif isinstance(py_val, dict):
+            _counters.python_attrsets_built += 1
             bb = ffi.gc(
                 lib.nix_make_bindings_builder(self._state, len(py_val)),
                 lib.nix_bindings_builder_free,
@@ -451,8 +1147,258 @@ class Value:
             lib.nix_make_attrs(self._value, bb)
         elif callable(py_val):
             # primops will give us a dispatcher, need to call it
-            p = PrimOp(py_val)
+            p = PrimOp(py_val, lazy=lazy)
             lib.nix_set_primop(self._value, p._primop)
             p.unref()
         else:
             raise TypeError("tried to convert unknown type to nix")
+
+
+def _set_lazy(v: Value, py_val: collections.abc.Mapping | collections.abc.Sequence | collections.abc.Iterator) -> None:
+    state = State.from_ptr(v._state)
+    if isinstance(py_val, collections.abc.Mapping):
+        mapping = py_val
+
+        def get_attr(name: Value, _: Value) -> Value:
+            return state.val_from_python(mapping[str(name)], lazy=True)
+
+        # mapAttrs leaves its results as thunks, so attributes are only converted when nix forces them
+        _counters.python_attrsets_built += 1
+        res = state.builtin("mapAttrs")(get_attr)(dict.fromkeys(mapping))
+    else:
+        items = py_val if isinstance(py_val, collections.abc.Sequence) else list(py_val)
+
+        def get_elem(i: Value) -> Value:
+            return state.val_from_python(items[int(i)], lazy=True)
+
+        # same for genList and list elements
+        _counters.python_lists_built += 1
+        res = state.builtin("genList")(get_elem)(len(items))
+    res.force_type()
+    lib.nix_copy_value(v._value, res._value)
+
+
+# a default that can't be confused with one passed by the caller
+_missing = object()
+
+
+def _attr_path(path: str | Iterable[str]) -> list[str]:
+    if isinstance(path, str):
+        return path.split(".") if path else []
+    return list(path)
+
+
+def _select(
+    v: Value, names: list[str], timeout: Optional[float] = None, cancel: Optional[CancellationToken] = None
+) -> Value:
+    def select() -> Value:
+        cur = v
+        for name in names:
+            cur = cur[name]
+        return cur
+    return watched(timeout, cancel, select)
+
+
+def _keys(v: Value, timeout: Optional[float] = None, cancel: Optional[CancellationToken] = None) -> list[str]:
+    return watched(timeout, cancel, lambda: list(v.keys()))
+
+
+def _elements(v: Value, timeout: Optional[float] = None, cancel: Optional[CancellationToken] = None) -> list[Value]:
+    return watched(timeout, cancel, lambda: list(v.iter_list()))
+
+
+def _captured(ctx: Context, err: int) -> Exception:
+    """ The exception for a failed raw call, to return instead of raising """
+    try:
+        ctx._err_check(err)
+    except Exception as e:
+        return e
+    return RuntimeError("unexpected error code", err)
+
+
+def _cell(ctx: Context, state: CData, row: CData, path: list[bytes], missing: Any) -> Any:
+    """ One cell of Value.columns, using raw calls on a single context """
+    c = ctx._ctx
+    cur = row
+    owned = []
+    try:
+        # the getters force what they return
+        for name in path:
+            if lib_unwrapped.nix_get_type(c, cur) != lib.NIX_TYPE_ATTRS:
+                return missing
+            cur = lib_unwrapped.nix_get_attr_byname(c, cur, state, name)
+            err = ctx.nix_err_code()
+            if err == lib.NIX_ERR_KEY:
+                return missing
+            if err != lib.NIX_OK:
+                return _captured(ctx, err)
+            owned.append(cur)
+        match lib_unwrapped.nix_get_type(c, cur):
+            case lib.NIX_TYPE_INT:
+                return int(lib_unwrapped.nix_get_int(c, cur))
+            case lib.NIX_TYPE_FLOAT:
+                return float(lib_unwrapped.nix_get_float(c, cur))
+            case lib.NIX_TYPE_BOOL:
+                return bool(lib_unwrapped.nix_get_bool(c, cur))
+            case lib.NIX_TYPE_STRING:
+                return ffi.string(lib_unwrapped.nix_get_string(c, cur)).decode()
+            case lib.NIX_TYPE_PATH:
+                return PurePath(ffi.string(lib_unwrapped.nix_get_path_string(c, cur)).decode())
+            case lib.NIX_TYPE_NULL:
+                return None
+            case _:
+                return Value(state, cur, make_reference=True)
+    finally:
+        for ptr in owned:
+            lib_unwrapped.nix_gc_decref(c, ptr)
+
+
+def _as_array(col: list[Any]) -> list[Any] | array.array:
+    if not col or any(type(x) not in (int, float) for x in col):
+        return col
+    return array.array("d" if any(type(x) is float for x in col) else "q", col)
+
+
+def _values_equal(a: Value, b: Value) -> bool:
+    if a._value == b._value:
+        return True
+    ta, tb = a.force_type(), b.force_type()
+    if ta != tb:
+        # nix compares ints and floats numerically
+        if {ta, tb} == {Type.int, Type.float}:
+            return bool(a._to_python() == b._to_python())
+        return False
+    match ta:
+        case Type.list:
+            if lib.nix_get_list_size(a._value) != lib.nix_get_list_size(b._value):
+                return False
+            return all(
+                _values_equal(x, y) for x, y in zip(a.iter_list(), b.iter_list())
+            )
+        case Type.attrs:
+            out_a, out_b = a._derivation_out_path(), b._derivation_out_path()
+            if out_a is not None and out_b is not None:
+                return out_a == out_b
+            if lib.nix_get_attrs_size(a._value) != lib.nix_get_attrs_size(b._value):
+                return False
+            for name in a.keys():
+                if not lib.nix_has_attr_byname(b._value, b._state, name.encode()):
+                    return False
+                if not _values_equal(a.get_attr_byname(name), b.get_attr_byname(name)):
+                    return False
+            return True
+        case Type.function:
+            # nix functions are only equal to themselves
+            return False
+        case Type.external:
+            return bool(a._get_external().equal(b._get_external()._x))
+        case _:
+            return bool(a._to_python() == b._to_python())
+
+
+def _value_hash(v: Value) -> int:
+    match v.force_type():
+        case Type.list:
+            return hash(tuple(hash(x) for x in v.iter_list()))
+        case Type.attrs:
+            out_path = v._derivation_out_path()
+            if out_path is not None:
+                return hash(("derivation", out_path))
+            res: set[tuple[str, int]] = set()
+            v.get_attr_iterate(lambda k, x: res.add((k, hash(x))))
+            return hash(frozenset(res))
+        case Type.function:
+            return hash(_address(v._value))
+        case Type.external:
+            return hash(v._get_external().typeOf())
+        case _:
+            return hash(v._to_python())
+
+
+class ListIterator(Iterator[Value]):
+    """ Iterator over the elements of an already forced Nix list """
+    def __init__(self, value: Value, indices: range, prefetch: int = 1) -> None:
+        """
+        :param value: The list Value, which must be forced already
+        :param indices: The element indices to visit
+        :param prefetch: Number of elements to wrap per batch
+        """
+        self._value = value
+        self._indices = indices
+        self._pos = 0
+        self._prefetch = max(1, prefetch)
+        self._batch: list[Value] = []
+        self._batch_pos = 0
+
+    def __iter__(self) -> ListIterator:
+        return self
+
+    def __length_hint__(self) -> int:
+        return len(self._indices) - self._pos + len(self._batch) - self._batch_pos
+
+    def __next__(self) -> Value:
+        if self._batch_pos < len(self._batch):
+            elem = self._batch[self._batch_pos]
+            self._batch_pos += 1
+            return elem
+        if self._pos >= len(self._indices):
+            raise StopIteration
+        value, state = self._value._value, self._value._state
+        if self._prefetch == 1:
+            ix = self._indices[self._pos]
+            self._pos += 1
+            return Value(state, lib.nix_get_list_byidx(value, state, ix))
+        get_list_byidx = lib.nix_get_list_byidx
+        end = min(self._pos + self._prefetch, len(self._indices))
+        self._batch = [
+            Value(state, get_list_byidx(value, state, ix))
+            for ix in self._indices[self._pos:end]
+        ]
+        self._pos = end
+        self._batch_pos = 1
+        return self._batch[0]
+
+    def chunks(self) -> Iterator[list[Value]]:
+        """ Yield the remaining elements in lists of (at most) `prefetch` elements """
+        while True:
+            chunk = list(itertools.islice(self, self._prefetch))
+            if not chunk:
+                return
+            yield chunk
+
+
+class ListView(collections.abc.Sequence[Value]):
+    """ A lazy slice of a Nix list. Elements are only wrapped when accessed. """
+    def __init__(self, value: Value, indices: range) -> None:
+        """
+        :param value: The list Value, which must be forced already
+        :param indices: The element indices of the original list in this view
+        """
+        self._value = value
+        self._indices = indices
+
+    def __len__(self) -> int:
+        return len(self._indices)
+
+    @typing.overload
+    def __getitem__(self, i: int) -> Value:
+        ...
+
+    @typing.overload
+    def __getitem__(self, i: slice) -> ListView:
+        ...
+
+    def __getitem__(self, i: int | slice) -> Value | ListView:
+        if isinstance(i, slice):
+            return ListView(self._value, self._indices[i])
+        return self._value.get_list_byidx(self._indices[i])
+
+    def __iter__(self) -> ListIterator:
+        return ListIterator(self._value, self._indices)
+
+    def iter_list(self, prefetch: int = 1) -> ListIterator:
+        """ Iterate over the view, wrapping elements in batches of `prefetch` """
+        return ListIterator(self._value, self._indices, prefetch)
+
+    def __repr__(self) -> str:
+        return f"<Nix list view ({len(self)} elements)>"
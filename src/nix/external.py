@@ -7,8 +7,10 @@ from typing import Any, Optional
 from .expr_util import ffi, lib, lib_unwrapped, CData, ReferenceGC
 
 
-def set_string_return(ret: CData, string: str) -> None:
-    typing.cast(CData, lib_unwrapped.nix_set_string_return(ret, string.encode()))
+def set_string_return(ret: CData, string: str | bytes) -> None:
+    if isinstance(string, str):
+        string = string.encode()
+    typing.cast(CData, lib_unwrapped.nix_set_string_return(ret, string))
 
 
 @ffi.def_extern()
@@ -70,6 +72,9 @@ class ExternalValueImpl(ReferenceGC):
     By default, this is suitable for wrapping any python value,
     but can be subclassed for added customization.
     """
+    passthrough: bool = False
+    "return the wrapped value itself instead of an ExternalValue when converting back to Python"
+
     def __init__(self, value: Any) -> None:
         """ Construct an external value
 
@@ -101,7 +106,7 @@ class ExternalValueImpl(ReferenceGC):
 
     def coerceToString(
         self, add_context: Callable[[str], None], copyMore: bool, copyToStore: bool
-    ) -> str:
+    ) -> str | bytes:
         """ Called when trying to represent the value as a string, in interpolation or using builtins.toString """
         return repr(self.value)
 
@@ -113,6 +118,47 @@ class ExternalValueImpl(ReferenceGC):
         return "<ExternalValue: " + repr(self.value) + ">"
 
 
+class BufferExternalValueImpl(ExternalValueImpl):
+    """ Wraps an object supporting the buffer protocol, like bytes, memoryview or mmap.
+    The value is handed to Nix as raw bytes when coerced to a string, without decoding,
+    and comes back to Python as the original object.
+    Keep in mind that Nix strings end at the first NUL byte.
+    """
+    passthrough = True
+
+    def __init__(self, value: Any) -> None:
+        with memoryview(value) as view:
+            self.nbytes = view.nbytes
+        # bytes can be passed to Nix as they are, other buffers are copied once, on first use
+        self._string: Optional[bytes] = value if isinstance(value, bytes) else None
+        super().__init__(value)
+
+    def print(self, printer: Callable[[str], None]) -> None:
+        printer(f"<py buffer: {self.nbytes} bytes>")
+
+    def showType(self) -> str:
+        return "Python buffer"
+
+    def coerceToString(
+        self, add_context: Callable[[str], None], copyMore: bool, copyToStore: bool
+    ) -> bytes:
+        if self._string is None:
+            with memoryview(self.value) as view:
+                self._string = view.tobytes()
+        return self._string
+
+    def equal(self, other: ExternalValueImpl) -> bool:
+        if not isinstance(other, BufferExternalValueImpl):
+            return False
+        if self.value is other.value:
+            return True
+        with memoryview(self.value) as a, memoryview(other.value) as b:
+            return a.cast("B") == b.cast("B")
+
+    def __repr__(self) -> str:
+        return f"<ExternalValue: {type(self.value).__name__} of {self.nbytes} bytes>"
+
+
 class ExternalValue:
     """ Represents a pointer to a Python value wrapped in a nix Value """
     def __init__(
@@ -0,0 +1,332 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import typing
+import urllib.parse
+from pathlib import Path
+from typing import Any, Optional
+
+from .expr import State, Value, Type
+from .util import settings, NixError, Interrupted
+
+__all__ = ["Flake", "AttrCursor", "EvalCache"]
+
+# the directory (below $XDG_CACHE_HOME/nix) where the nix CLI keeps its evaluation caches
+EVAL_CACHE_DIR = "eval-cache-v5"
+# where impure evaluation results are cached instead, as the CLI only uses its cache in pure mode
+PRIVATE_CACHE_DIR = "python-nix"
+
+
+class AttrType:
+    """ Attribute types in the eval cache, as numbered by libexpr's eval-cache.cc """
+    placeholder = 0
+    full_attrs = 1
+    string = 2
+    missing = 3
+    misc = 4
+    failed = 5
+    bool = 6
+    list_of_strings = 7
+    int = 8
+
+
+class EvalCache:
+    """ An evaluation cache database, in the format used by the nix CLI """
+    def __init__(self, path: str | Path) -> None:
+        """
+        :param path: The sqlite file to open or create
+        """
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("pragma synchronous = off")
+        self._db.execute("pragma main.journal_mode = truncate")
+        self._db.execute(
+            """create table if not exists Attributes (
+                parent      integer not null,
+                name        text,
+                type        integer not null,
+                value       text,
+                context     text,
+                primary key (parent, name)
+            )"""
+        )
+
+    def lookup(self, parent: int, name: str) -> Optional[tuple[int, int, Any, Optional[str]]]:
+        """ Look up an attribute, returning (rowid, type, value, context) """
+        row = self._db.execute(
+            "select rowid, type, value, context from Attributes where parent = ? and name = ?",
+            (parent, name),
+        ).fetchone()
+        return None if row is None else (row[0], row[1], row[2], row[3])
+
+    def children(self, rowid: int) -> list[str]:
+        return [
+            r[0]
+            for r in self._db.execute(
+                "select name from Attributes where parent = ? order by name", (rowid,)
+            )
+        ]
+
+    def set(
+        self, parent: int, name: str, tp: int, value: Any = 0, context: Optional[str] = None
+    ) -> int:
+        """ Store an attribute, returning its rowid """
+        with self._db:
+            cur = self._db.execute(
+                "insert or replace into Attributes(parent, name, type, value, context) values (?, ?, ?, ?, ?)",
+                (parent, name, tp, value, context),
+            )
+        return _rowid(cur.lastrowid)
+
+    def set_attrs(self, parent: int, name: str, names: list[str]) -> int:
+        """ Store an attribute set, with placeholders for its attributes """
+        with self._db:
+            cur = self._db.execute(
+                "insert or replace into Attributes(parent, name, type, value, context) values (?, ?, ?, 0, 0)",
+                (parent, name, AttrType.full_attrs),
+            )
+            rowid = _rowid(cur.lastrowid)
+            self._db.executemany(
+                "insert or ignore into Attributes(parent, name, type, value, context) values (?, ?, ?, 0, 0)",
+                [(rowid, n, AttrType.placeholder) for n in names],
+            )
+        return rowid
+
+
+def _rowid(rowid: Optional[int]) -> int:
+    assert rowid is not None
+    return rowid
+
+
+class Flake:
+    """ A flake, with attribute access through the evaluation cache of the nix CLI.
+
+    Requires the flakes experimental feature to be enabled in nix.util.settings.
+    """
+    def __init__(self, ref: str, state: Optional[State] = None, use_cache: bool = True) -> None:
+        """
+        :param ref: A flake reference, like "github:NixOS/nixpkgs" or "/path/to/flake"
+        :param state: The State to evaluate in, by default the one used by nix.eval
+        :param use_cache: Read and fill the eval cache when the flake is locked
+        """
+        self.ref = ref
+        self.use_cache = use_cache
+        self._state = state
+        self._value: Optional[Value] = None
+        self._cache: Optional[EvalCache] = None
+        self._cache_opened = False
+
+    @property
+    def value(self) -> Value:
+        """ The result of builtins.getFlake, fetched on first use """
+        if self._value is None:
+            if self._state is None:
+                from . import eval
+                get_flake = eval("builtins.getFlake")
+            else:
+                get_flake = self._state.eval_string("builtins.getFlake", ".")
+            self._value = get_flake(self.ref)
+        return self._value
+
+    def fingerprint(self) -> Optional[str]:
+        """ The key of this flake in the eval cache, or None if the flake is not locked.
+        Computed the way Nix 2.18 does: from the source store path, subdirectory,
+        revision count, last modification time and lock file.
+        """
+        flake = self.value
+        if "rev" not in flake and ("narHash" not in flake or "dirtyRev" in flake):
+            return None
+        source = str(flake["outPath"])
+        subdir = urllib.parse.parse_qs(urllib.parse.urlparse(self.ref).query).get("dir", [""])[0]
+        rev_count = int(flake["revCount"]) if "revCount" in flake else 0
+        last_modified = int(flake["lastModified"]) if "lastModified" in flake else 0
+        lock_path = Path(source, subdir, "flake.lock")
+        lock_file = lock_path.read_text().rstrip("\n") if lock_path.exists() else ""
+        fingerprint = f"{os.path.basename(source)};{subdir};{rev_count};{last_modified};{lock_file}"
+        return hashlib.sha256(fingerprint.encode()).hexdigest()
+
+    @property
+    def cache(self) -> Optional[EvalCache]:
+        """ The eval cache of this flake, or None if it is not locked or caching is disabled.
+
+        In pure evaluation mode (the pure-eval setting) this is the cache of the nix CLI.
+        Otherwise results may depend on the environment, so they go to a separate cache
+        that the CLI doesn't read.
+        """
+        if not self._cache_opened:
+            self._cache_opened = True
+            fingerprint = self.fingerprint() if self.use_cache else None
+            if fingerprint is not None:
+                cache_home = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+                owner = "nix" if _pure_eval() else PRIVATE_CACHE_DIR
+                self._cache = EvalCache(
+                    os.path.join(cache_home, owner, EVAL_CACHE_DIR, fingerprint + ".sqlite")
+                )
+        return self._cache
+
+    def root(self) -> AttrCursor:
+        """ A cursor on the outputs of the flake """
+        return AttrCursor(self, None, "")
+
+    def __getitem__(self, name: str) -> AttrCursor:
+        return self.root()[name]
+
+    def keys(self) -> list[str]:
+        return self.root().keys()
+
+
+def _pure_eval() -> bool:
+    try:
+        return settings["pure-eval"] == "true"
+    except Exception:
+        return False
+
+
+class AttrCursor:
+    """ A lazy pointer to an attribute of a flake's outputs.
+    Listings and leaf values are served from the eval cache when possible,
+    and only evaluated (and then cached) when they are not.
+    """
+    def __init__(self, flake: Flake, parent: Optional[AttrCursor], name: str) -> None:
+        self.flake = flake
+        self.parent = parent
+        self.name = name
+        self._row: Optional[tuple[int, int, Any, Optional[str]]] = None
+        self._value: Optional[Value] = None
+
+    @property
+    def path(self) -> list[str]:
+        if self.parent is None:
+            return []
+        return self.parent.path + [self.name]
+
+    def __repr__(self) -> str:
+        return f"<AttrCursor {'.'.join(self.path)}>"
+
+    def _parent_rowid(self) -> Optional[int]:
+        if self.parent is None:
+            return 0
+        row = self.parent._cached_row()
+        return None if row is None else row[0]
+
+    def _cached_row(self) -> Optional[tuple[int, int, Any, Optional[str]]]:
+        cache = self.flake.cache
+        if cache is None:
+            return None
+        if self._row is None:
+            parent = self._parent_rowid()
+            if parent is not None:
+                self._row = cache.lookup(parent, self.name)
+        return self._row
+
+    def _store(self, tp: int, value: Any = 0, context: Optional[str] = None) -> None:
+        cache = self.flake.cache
+        parent = self._parent_rowid()
+        if cache is None or parent is None:
+            return
+        rowid = cache.set(parent, self.name, tp, value, context)
+        self._row = (rowid, tp, value, context)
+
+    @property
+    def value(self) -> Value:
+        """ The evaluated Value of this attribute, bypassing the cache """
+        if self._value is None:
+            if self.parent is None:
+                self._value = self.flake.value["outputs"]
+            else:
+                self._value = self.parent.value[self.name]
+            # like the CLI, mark evaluated attributes, so their children can be cached
+            if self._cached_row() is None:
+                self._store(AttrType.placeholder)
+        return self._value
+
+    def __getitem__(self, name: str) -> AttrCursor:
+        row = self._cached_row()
+        if row is not None and row[1] == AttrType.full_attrs:
+            cache = self.flake.cache
+            assert cache is not None
+            if cache.lookup(row[0], name) is None:
+                raise KeyError(name)
+            return AttrCursor(self.flake, self, name)
+        if name not in self.value:
+            raise KeyError(name)
+        return AttrCursor(self.flake, self, name)
+
+    def keys(self) -> list[str]:
+        """ The attribute names of this attribute set """
+        row = self._cached_row()
+        cache = self.flake.cache
+        if row is not None and row[1] == AttrType.full_attrs and cache is not None:
+            return cache.children(row[0])
+        names = sorted(self.value.keys())
+        parent = self._parent_rowid()
+        if cache is not None and parent is not None:
+            rowid = cache.set_attrs(parent, self.name, names)
+            self._row = (rowid, AttrType.full_attrs, 0, None)
+        return names
+
+    def get(self) -> Any:
+        """ The value of this attribute as a Python value.
+        Strings, booleans, integers and lists of strings come from the cache when possible.
+        Other values are returned as they are evaluated.
+        """
+        row = self._cached_row()
+        if row is not None:
+            match row[1]:
+                case AttrType.string:
+                    return row[2]
+                case AttrType.bool:
+                    return bool(int(row[2]))
+                case AttrType.int:
+                    return int(row[2])
+                case AttrType.list_of_strings:
+                    return row[2].split("\t") if row[2] else []
+                case AttrType.missing:
+                    raise KeyError(self.name)
+        try:
+            tp = self.value.force_type()
+        except NixError as e:
+            # a timeout or cancellation says nothing about the attribute, and the CLI would report it as failed
+            if not isinstance(e, Interrupted):
+                self._store(AttrType.failed)
+            raise
+        match tp:
+            case Type.string:
+                res = str(self.value)
+                self._store(AttrType.string, res, self._context())
+                return res
+            case Type.bool:
+                res_bool = bool(self.value)
+                self._store(AttrType.bool, int(res_bool))
+                return res_bool
+            case Type.int:
+                res_int = int(self.value)
+                self._store(AttrType.int, res_int)
+                return res_int
+            case Type.list:
+                res_list = typing.cast(list[Any], self.value.force(deep=True))
+                if all(isinstance(x, str) for x in res_list):
+                    self._store(AttrType.list_of_strings, "\t".join(res_list))
+                else:
+                    self._store(AttrType.misc)
+                return res_list
+            case Type.attrs:
+                self.keys()
+                return self.value
+            case _:
+                self._store(AttrType.misc)
+                return self.value.force()
+
+    def _context(self) -> str:
+        """ The string context in the encoding of the eval cache """
+        res = []
+        for path, info in self.value.string_context().items():
+            if info.get("path"):
+                res.append(path)
+            if info.get("allOutputs"):
+                res.append("=" + path)
+            for output in info.get("outputs", []):
+                res.append(f"!{output}!{path}")
+        return " ".join(res)
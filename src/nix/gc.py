@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import contextlib
+import threading
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
+from typing import Optional
+
+# load libnixexpr, and with it the libgc that Nix uses, before ours
+from . import expr_util  # noqa: F401
+from ._nix_api_gc import ffi, lib
+
+__all__ = [
+    "HeapStats",
+    "collect",
+    "stats",
+    "poll",
+    "set_max_heap_size",
+    "set_free_space_divisor",
+    "get_free_space_divisor",
+    "add_collection_hook",
+    "remove_collection_hook",
+    "start_monitor",
+    "stop_monitor",
+    "allow_register_threads",
+    "registered_thread",
+]
+
+
+@dataclass(frozen=True)
+class HeapStats:
+    """ Statistics of the Boehm GC heap that backs all Nix values """
+    heap_size: int
+    "size of the heap in bytes, including free space"
+    free_bytes: int
+    "free bytes in the heap"
+    bytes_since_gc: int
+    "bytes allocated since the last collection"
+    total_bytes: int
+    "bytes allocated since the start of the process"
+    collections: int
+    "number of completed collections"
+
+
+CollectionHook = Callable[[HeapStats], None]
+
+_hooks: list[CollectionHook] = []
+_lock = threading.Lock()
+_seen_collections = 0
+_monitor: Optional[_Monitor] = None
+
+
+def stats() -> HeapStats:
+    """ Read the current heap statistics, running the collection hooks if a collection happened since the last check """
+    res = _read_stats()
+    _run_hooks(res)
+    return res
+
+
+def collect() -> HeapStats:
+    """ Run a full garbage collection and return the heap statistics afterwards """
+    lib.GC_gcollect()
+    return stats()
+
+
+def poll() -> None:
+    """ Run the collection hooks if a collection happened since the last check """
+    stats()
+
+
+def set_max_heap_size(size: int) -> None:
+    """ Limit the heap to `size` bytes. Allocations beyond that fail with an out of memory error. 0 means unlimited. """
+    lib.GC_set_max_heap_size(size)
+
+
+def set_free_space_divisor(divisor: int) -> None:
+    """ Trade memory for collection frequency: higher values collect more often and keep the heap smaller. The default is 3. """
+    if divisor < 1:
+        raise ValueError("free space divisor should be at least 1")
+    lib.GC_set_free_space_divisor(divisor)
+
+
+def get_free_space_divisor() -> int:
+    return int(lib.GC_get_free_space_divisor())
+
+
+def add_collection_hook(hook: CollectionHook) -> None:
+    """ Call `hook` with the heap statistics after garbage collections.
+
+    Boehm does not allow calling into Python while it collects, so hooks run the next time
+    the collection count is checked: by collect(), stats(), poll(), or the monitor thread (see start_monitor).
+    Several collections between two checks result in one call.
+    """
+    global _seen_collections
+    with _lock:
+        if not _hooks:
+            _seen_collections = int(lib.GC_get_gc_no())
+        _hooks.append(hook)
+
+
+def remove_collection_hook(hook: CollectionHook) -> None:
+    with _lock:
+        _hooks.remove(hook)
+
+
+def start_monitor(interval: float = 0.1) -> None:
+    """ Check for collections every `interval` seconds in a background thread, so hooks run without explicit polling """
+    global _monitor
+    allow_register_threads()
+    with _lock:
+        if _monitor is not None:
+            return
+        _monitor = _Monitor(interval)
+    _monitor.start()
+
+
+def stop_monitor() -> None:
+    global _monitor
+    with _lock:
+        monitor, _monitor = _monitor, None
+    if monitor is not None:
+        monitor.stop()
+
+
+def allow_register_threads() -> None:
+    """ Allow other threads to register with registered_thread().
+    Call this from the main thread (or another registered thread), after Nix is initialized.
+    """
+    lib.GC_allow_register_threads()
+
+
+@contextlib.contextmanager
+def registered_thread() -> Iterator[None]:
+    """ Register the current thread with the garbage collector for the duration of the with block.
+
+    Threads that evaluate Nix code or hold Nix values on their stack must be registered:
+    Boehm only scans the stacks of threads it knows about, and aborts when an unknown thread
+    starts a collection. The main thread is registered already. See allow_register_threads().
+    """
+    sb = ffi.new("struct GC_stack_base*")
+    if lib.GC_get_stack_base(sb) != lib.GC_SUCCESS:
+        raise RuntimeError("can't find the stack of the current thread")
+    res = lib.GC_register_my_thread(sb)
+    if res == lib.GC_DUPLICATE:
+        yield
+        return
+    if res != lib.GC_SUCCESS:
+        raise RuntimeError("can't register the current thread with the garbage collector")
+    try:
+        yield
+    finally:
+        lib.GC_unregister_my_thread()
+
+
+def _read_stats() -> HeapStats:
+    return HeapStats(
+        heap_size=int(lib.GC_get_heap_size()),
+        free_bytes=int(lib.GC_get_free_bytes()),
+        bytes_since_gc=int(lib.GC_get_bytes_since_gc()),
+        total_bytes=int(lib.GC_get_total_bytes()),
+        collections=int(lib.GC_get_gc_no()),
+    )
+
+
+def _run_hooks(res: HeapStats) -> None:
+    global _seen_collections
+    with _lock:
+        if not _hooks or res.collections == _seen_collections:
+            return
+        _seen_collections = res.collections
+        hooks = list(_hooks)
+    for hook in hooks:
+        hook(res)
+
+
+class _Monitor(threading.Thread):
+    def __init__(self, interval: float) -> None:
+        super().__init__(name="nix-gc-monitor", daemon=True)
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        # hooks may evaluate
+        with registered_thread():
+            while not self._stopped.wait(self.interval):
+                poll()
+
+    def stop(self) -> None:
+        self._stopped.set()
@@ -0,0 +1,333 @@
+"""
+Incremental package metadata index for nixpkgs-like trees.
+
+Usage: python -m nix.index [--jobs N] [--full] <tree> <index.sqlite>
+
+Top-level attributes are evaluated in worker processes, following recurseForDerivations.
+Records are written to an SQLite database as the workers produce them.
+On later runs, only the top-level attributes whose packages (meta.position) or
+package set attributes (builtins.unsafeGetAttrPos) are defined in files that
+changed since the last run are evaluated again.
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from .expr import State, Value, Type
+from .store import Store
+from .derivation import is_derivation
+
+__all__ = ["Record", "Index", "build_index", "main"]
+
+
+@dataclass
+class Record:
+    """ The indexed metadata of one package """
+    attr: str
+    name: str
+    pname: Optional[str] = None
+    version: Optional[str] = None
+    description: Optional[str] = None
+    license: list[str] = field(default_factory=list)
+    platforms: list[str] = field(default_factory=list)
+    position: Optional[str] = None
+
+    @property
+    def file(self) -> Optional[str]:
+        """ The file that defines the package """
+        if self.position is None:
+            return None
+        return self.position.rsplit(":", 1)[0]
+
+
+@dataclass
+class TopLevelResult:
+    """ The records under one top-level attribute, as produced by a worker """
+    attr: str
+    records: list[Record] = field(default_factory=list)
+    error: Optional[str] = None
+    files: set[str] = field(default_factory=set)
+    "files defining the attributes of the package sets below it, so new packages are noticed"
+
+
+def _string(v: Value, name: str) -> Optional[str]:
+    try:
+        if name not in v:
+            return None
+        x = v[name]
+        if x.force_type() != Type.string:
+            return None
+        return str(x)
+    except Exception:
+        return None
+
+
+def _licenses(meta: Value) -> list[str]:
+    if "license" not in meta:
+        return []
+    lic = meta["license"]
+    items = list(lic) if lic.force_type() == Type.list else [lic]
+    res = []
+    for item in items:
+        if item.force_type() == Type.string:
+            res.append(str(item))
+        elif item.force_type() == Type.attrs:
+            name = _string(item, "spdxId") or _string(item, "shortName")
+            if name is not None:
+                res.append(name)
+    return res
+
+
+def _platforms(meta: Value) -> list[str]:
+    if "platforms" not in meta:
+        return []
+    return [str(p) for p in meta["platforms"] if p.force_type() == Type.string]
+
+
+def _record(attr: str, drv: Value) -> Record:
+    rec = Record(attr, _string(drv, "name") or attr, _string(drv, "pname"), _string(drv, "version"))
+    if "meta" in drv:
+        meta = drv["meta"]
+        if meta.force_type() == Type.attrs:
+            rec.description = _string(meta, "description")
+            rec.position = _string(meta, "position")
+            try:
+                rec.license = _licenses(meta)
+                rec.platforms = _platforms(meta)
+            except Exception:
+                pass
+    return rec
+
+
+def _attr_file(v: Value, name: str) -> Optional[str]:
+    """ The file that defines attribute `name` of `v`, if Nix knows it """
+    try:
+        pos = State.from_ptr(v._state).builtin("unsafeGetAttrPos")(name)(v)
+        if pos.force_type() != Type.attrs:
+            return None
+        return str(pos["file"])
+    except Exception:
+        return None
+
+
+def _walk(attr: str, v: Value, files: set[str]) -> Iterator[Record]:
+    try:
+        if v.force_type() != Type.attrs:
+            return
+        if is_derivation(v):
+            yield _record(attr, v)
+            return
+        # package sets are only indexed when they ask for it, like in nix-env
+        if "recurseForDerivations" not in v or not bool(v["recurseForDerivations"]):
+            return
+        names = list(v.keys())
+    except Exception:
+        return
+    for name in names:
+        file = _attr_file(v, name)
+        if file is not None:
+            files.add(file)
+        try:
+            # forces the attribute, which may be a throwing alias
+            child = v[name]
+        except Exception:
+            continue
+        yield from _walk(attr + "." + name, child, files)
+
+
+# the evaluated package set, in worker processes
+_pkgs: Optional[Value] = None
+
+
+def _init_worker(expr: str, path: str) -> None:
+    global _pkgs
+    _pkgs = State([], Store()).eval_string(expr, path)
+
+
+def _index_chunk(attrs: list[str]) -> list[TopLevelResult]:
+    assert _pkgs is not None
+    res = []
+    for attr in attrs:
+        item = TopLevelResult(attr)
+        try:
+            item.records = list(_walk(attr, _pkgs[attr], item.files))
+        except Exception as e:
+            item.error = str(e)
+        res.append(item)
+    return res
+
+
+def _digest(path: str) -> Optional[str]:
+    h = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    except OSError:
+        return None
+    return h.hexdigest()
+
+
+class Index:
+    """ The on-disk index """
+    def __init__(self, path: str) -> None:
+        self._db = sqlite3.connect(path)
+        self._db.executescript(
+            """
+            create table if not exists packages (
+                attr        text primary key,
+                toplevel    text not null,
+                name        text not null,
+                pname       text,
+                version     text,
+                description text,
+                license     text,
+                platforms   text,
+                position    text
+            );
+            create index if not exists packages_toplevel on packages(toplevel);
+            create table if not exists toplevels (
+                attr        text primary key,
+                files       text not null,
+                error       text
+            );
+            create table if not exists files (
+                path        text primary key,
+                digest      text
+            );
+            """
+        )
+
+    def changed_files(self) -> set[str]:
+        """ Files that changed since they were last indexed """
+        return {
+            path
+            for path, digest in self._db.execute("select path, digest from files")
+            if _digest(path) != digest
+        }
+
+    def stale_toplevels(self, names: list[str]) -> list[str]:
+        """ The top-level attributes that need to be (re-)evaluated """
+        changed = self.changed_files()
+        known = {
+            attr: (set(json.loads(files)), error)
+            for attr, files, error in self._db.execute("select attr, files, error from toplevels")
+        }
+        return [
+            name
+            for name in names
+            if name not in known or known[name][1] is not None or known[name][0] & changed
+        ]
+
+    def remove_missing(self, names: list[str]) -> None:
+        """ Drop the top-level attributes that no longer exist """
+        current = set(names)
+        gone = [
+            (attr,) for (attr,) in self._db.execute("select attr from toplevels") if attr not in current
+        ]
+        with self._db:
+            self._db.executemany("delete from packages where toplevel = ?", gone)
+            self._db.executemany("delete from toplevels where attr = ?", gone)
+
+    def write(self, result: TopLevelResult) -> None:
+        files = sorted(result.files | {r.file for r in result.records if r.file is not None})
+        with self._db:
+            self._db.execute("delete from packages where toplevel = ?", (result.attr,))
+            self._db.executemany(
+                "insert or replace into packages values (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        r.attr,
+                        result.attr,
+                        r.name,
+                        r.pname,
+                        r.version,
+                        r.description,
+                        json.dumps(r.license),
+                        json.dumps(r.platforms),
+                        r.position,
+                    )
+                    for r in result.records
+                ],
+            )
+            self._db.execute(
+                "insert or replace into toplevels values (?, ?, ?)",
+                (result.attr, json.dumps(files), result.error),
+            )
+            self._db.executemany(
+                "insert or replace into files values (?, ?)",
+                [(f, _digest(f)) for f in files],
+            )
+
+    def search(self, term: str) -> list[dict[str, Any]]:
+        """ Find packages by attribute, name or description """
+        pattern = f"%{term}%"
+        cur = self._db.execute(
+            "select * from packages where attr like ? or name like ? or description like ? order by attr",
+            (pattern, pattern, pattern),
+        )
+        cols = [d[0] for d in cur.description]
+        return [dict(zip(cols, row)) for row in cur]
+
+
+def build_index(
+    tree: str,
+    index_path: str,
+    jobs: Optional[int] = None,
+    full: bool = False,
+    chunk_size: int = 32,
+) -> int:
+    """ Index (or update the index of) the packages of a nixpkgs-like tree
+
+    :param tree: Path to the tree, evaluated as `import <tree> {}`
+    :param index_path: The sqlite database to write
+    :param jobs: Number of worker processes, by default the number of CPUs
+    :param full: Re-evaluate every attribute
+    :param chunk_size: Number of top-level attributes per work item
+    :return: The number of top-level attributes that were evaluated
+    """
+    tree = os.path.abspath(tree)
+    expr = f"import {json.dumps(tree)} {{}}"
+    index = Index(index_path)
+
+    # evaluate the attribute names in a short-lived child, nix is not fork-safe
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(1) as pool:
+        names = pool.apply(_attr_names, (expr, tree))
+    index.remove_missing(names)
+    todo = names if full else index.stale_toplevels(names)
+
+    chunks = [todo[i:i + chunk_size] for i in range(0, len(todo), chunk_size)]
+    with ctx.Pool(jobs, initializer=_init_worker, initargs=(expr, tree)) as pool:
+        for results in pool.imap_unordered(_index_chunk, chunks):
+            for result in results:
+                index.write(result)
+    return len(todo)
+
+
+def _attr_names(expr: str, path: str) -> list[str]:
+    return sorted(State([], Store()).eval_string(expr, path).keys())
+
+
+def main(args: list[str]) -> None:
+    parser = argparse.ArgumentParser(prog="python -m nix.index", description=__doc__.split("\n")[1])
+    parser.add_argument("tree", help="path to a nixpkgs-like tree")
+    parser.add_argument("index", help="sqlite database to create or update")
+    parser.add_argument("--jobs", "-j", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--full", action="store_true", help="re-evaluate all attributes")
+    opts = parser.parse_args(args)
+    count = build_index(opts.tree, opts.index, opts.jobs, opts.full)
+    print(f"evaluated {count} top-level attributes", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
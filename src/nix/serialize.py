@@ -0,0 +1,280 @@
+"""
+A compact binary format for evaluated Nix values, for IPC and caching.
+
+A blob is the magic b"NIXV", a format version byte and one encoded value.
+Every value starts with a one byte tag:
+
+- null, false, true: just the tag
+- int: zigzag encoded LEB128 varint
+- float: 8 byte little endian double
+- string, path: varint length and UTF-8 bytes
+- list: varint length and the elements
+- attrs: varint length and (name, value) pairs in attribute order.
+  Names are interned: a name is the varint index of an earlier name,
+  or the next free index followed by a varint length and the bytes of a new name.
+
+Values are read from and written to Nix directly through the C API, without intermediate Python structures.
+String contexts are not preserved. Functions and external values can't be serialized.
+"""
+from __future__ import annotations
+
+import mmap
+import os
+import struct
+from typing import TYPE_CHECKING
+
+from .expr_util import ffi, lib, lib_unwrapped, CData
+from .util import Ctx, Context
+
+if TYPE_CHECKING:
+    from .expr import State, Value
+
+__all__ = ["dumps", "loads", "load", "FormatError"]
+
+MAGIC = b"NIXV"
+VERSION = 1
+
+TAG_NULL = 0
+TAG_FALSE = 1
+TAG_TRUE = 2
+TAG_INT = 3
+TAG_FLOAT = 4
+TAG_STRING = 5
+TAG_PATH = 6
+TAG_LIST = 7
+TAG_ATTRS = 8
+
+_double = struct.Struct("<d")
+
+
+class FormatError(ValueError):
+    """ The buffer is not a valid serialized value """
+    pass
+
+
+def _check(ctx: Context) -> None:
+    err = ctx.nix_err_code()
+    if err != lib.NIX_OK:
+        ctx._err_check(err)
+
+
+def _write_varint(out: bytearray, n: int) -> None:
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _write_bytes(out: bytearray, data: bytes) -> None:
+    _write_varint(out, len(data))
+    out += data
+
+
+class _Writer:
+    def __init__(self, ctx: Context, state: CData) -> None:
+        self.ctx = ctx
+        self.c = ctx._ctx
+        self.state = state
+        self.out = bytearray(MAGIC)
+        self.out.append(VERSION)
+        self.names: dict[bytes, int] = {}
+
+    def value(self, v: CData) -> None:
+        c, out = self.c, self.out
+        tp = lib_unwrapped.nix_get_type(c, v)
+        if tp == lib.NIX_TYPE_THUNK:
+            lib_unwrapped.nix_value_force(c, self.state, v)
+            _check(self.ctx)
+            tp = lib_unwrapped.nix_get_type(c, v)
+        if tp == lib.NIX_TYPE_NULL:
+            out.append(TAG_NULL)
+        elif tp == lib.NIX_TYPE_BOOL:
+            out.append(TAG_TRUE if lib_unwrapped.nix_get_bool(c, v) else TAG_FALSE)
+        elif tp == lib.NIX_TYPE_INT:
+            n = int(lib_unwrapped.nix_get_int(c, v))
+            out.append(TAG_INT)
+            _write_varint(out, (n << 1) ^ (n >> 63))
+        elif tp == lib.NIX_TYPE_FLOAT:
+            out.append(TAG_FLOAT)
+            out += _double.pack(lib_unwrapped.nix_get_float(c, v))
+        elif tp == lib.NIX_TYPE_STRING:
+            out.append(TAG_STRING)
+            _write_bytes(out, ffi.string(lib_unwrapped.nix_get_string(c, v)))
+        elif tp == lib.NIX_TYPE_PATH:
+            out.append(TAG_PATH)
+            _write_bytes(out, ffi.string(lib_unwrapped.nix_get_path_string(c, v)))
+        elif tp == lib.NIX_TYPE_LIST:
+            size = int(lib_unwrapped.nix_get_list_size(c, v))
+            out.append(TAG_LIST)
+            _write_varint(out, size)
+            for i in range(size):
+                elem = lib_unwrapped.nix_get_list_byidx(c, v, self.state, i)
+                _check(self.ctx)
+                try:
+                    self.value(elem)
+                finally:
+                    lib_unwrapped.nix_gc_decref(c, elem)
+        elif tp == lib.NIX_TYPE_ATTRS:
+            size = int(lib_unwrapped.nix_get_attrs_size(c, v))
+            out.append(TAG_ATTRS)
+            _write_varint(out, size)
+            name_ptr = ffi.new("char**")
+            for i in range(size):
+                elem = lib_unwrapped.nix_get_attr_byidx(c, v, self.state, i, name_ptr)
+                _check(self.ctx)
+                try:
+                    self.name(ffi.string(name_ptr[0]))
+                    self.value(elem)
+                finally:
+                    lib_unwrapped.nix_gc_decref(c, elem)
+        else:
+            typename = ffi.string(lib_unwrapped.nix_get_typename(c, v)).decode()
+            raise TypeError(f"can't serialize a nix {typename}")
+
+    def name(self, name: bytes) -> None:
+        ix = self.names.get(name)
+        if ix is not None:
+            _write_varint(self.out, ix)
+            return
+        ix = self.names[name] = len(self.names)
+        _write_varint(self.out, ix)
+        _write_bytes(self.out, name)
+
+
+def dumps(value: Value) -> bytes:
+    """ Serialize a value, forcing it deeply """
+    with Ctx() as ctx:
+        writer = _Writer(ctx, value._state)
+        writer.value(value._value)
+    return bytes(writer.out)
+
+
+class _Reader:
+    def __init__(self, ctx: Context, state: CData, buf: memoryview) -> None:
+        self.ctx = ctx
+        self.c = ctx._ctx
+        self.state = state
+        self.buf = buf
+        self.pos = 0
+        self.names: list[bytes] = []
+
+    def byte(self) -> int:
+        try:
+            b = self.buf[self.pos]
+        except IndexError:
+            raise FormatError("unexpected end of data") from None
+        self.pos += 1
+        return b
+
+    def varint(self) -> int:
+        res = shift = 0
+        while True:
+            b = self.byte()
+            res |= (b & 0x7F) << shift
+            if b < 0x80:
+                return res
+            shift += 7
+
+    def blob(self) -> bytes:
+        n = self.varint()
+        end = self.pos + n
+        if end > len(self.buf):
+            raise FormatError("unexpected end of data")
+        res = bytes(self.buf[self.pos:end])
+        self.pos = end
+        return res
+
+    def value(self, v: CData) -> None:
+        """ Read a value into the allocated Value* `v` """
+        c = self.c
+        tag = self.byte()
+        if tag == TAG_NULL:
+            lib_unwrapped.nix_set_null(c, v)
+        elif tag == TAG_FALSE or tag == TAG_TRUE:
+            lib_unwrapped.nix_set_bool(c, v, tag == TAG_TRUE)
+        elif tag == TAG_INT:
+            n = self.varint()
+            lib_unwrapped.nix_set_int(c, v, (n >> 1) ^ -(n & 1))
+        elif tag == TAG_FLOAT:
+            if self.pos + 8 > len(self.buf):
+                raise FormatError("unexpected end of data")
+            (f,) = _double.unpack_from(self.buf, self.pos)
+            self.pos += 8
+            lib_unwrapped.nix_set_double(c, v, f)
+        elif tag == TAG_STRING:
+            lib_unwrapped.nix_set_string(c, v, self.blob())
+        elif tag == TAG_PATH:
+            lib_unwrapped.nix_set_path_string(c, v, self.blob())
+        elif tag == TAG_LIST:
+            size = self.varint()
+            lib_unwrapped.nix_make_list(c, self.state, v, size)
+            _check(self.ctx)
+            for i in range(size):
+                elem = self.alloc()
+                try:
+                    self.value(elem)
+                    lib_unwrapped.nix_set_list_byidx(c, v, i, elem)
+                finally:
+                    lib_unwrapped.nix_gc_decref(c, elem)
+        elif tag == TAG_ATTRS:
+            size = self.varint()
+            bb = ffi.gc(
+                lib.nix_make_bindings_builder(self.state, size),
+                lib.nix_bindings_builder_free,
+            )
+            for _ in range(size):
+                name = self.name()
+                elem = self.alloc()
+                try:
+                    self.value(elem)
+                    lib_unwrapped.nix_bindings_builder_insert(c, bb, name, elem)
+                finally:
+                    lib_unwrapped.nix_gc_decref(c, elem)
+            lib_unwrapped.nix_make_attrs(c, v, bb)
+        else:
+            raise FormatError(f"unknown tag {tag} at offset {self.pos - 1}")
+        _check(self.ctx)
+
+    def alloc(self) -> CData:
+        v = lib_unwrapped.nix_alloc_value(self.c, self.state)
+        _check(self.ctx)
+        return v
+
+    def name(self) -> bytes:
+        ix = self.varint()
+        if ix < len(self.names):
+            return self.names[ix]
+        if ix != len(self.names):
+            raise FormatError(f"attribute name index {ix} out of order")
+        name = self.blob()
+        self.names.append(name)
+        return name
+
+
+def loads(state: State, buf: bytes | bytearray | memoryview | mmap.mmap) -> Value:
+    """ Deserialize a value into `state` """
+    from .expr import Value
+
+    # released explicitly, so a memory-mapped buffer can be closed afterwards
+    with memoryview(buf) as raw, raw.cast("B") as view:
+        if bytes(view[:4]) != MAGIC:
+            raise FormatError("not a serialized nix value")
+        if len(view) < 5 or view[4] != VERSION:
+            raise FormatError("unsupported format version")
+        res = Value(state._state)
+        with Ctx() as ctx:
+            reader = _Reader(ctx, state._state, view)
+            reader.pos = 5
+            reader.value(res._value)
+        if reader.pos != len(view):
+            raise FormatError("trailing data after value")
+    return res
+
+
+def load(state: State, path: str | os.PathLike[str]) -> Value:
+    """ Deserialize a file, memory-mapping it instead of reading it into memory """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise FormatError("not a serialized nix value")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return loads(state, m)
@@ -1,6 +1,19 @@
 from __future__ import annotations
 
-from typing import TypeAlias, Optional
+import contextlib
+import hashlib
+import os
+import stat
+import struct
+import tempfile
+import threading
+import time
+import typing
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import PurePath
+from typing import TypeAlias, Optional, BinaryIO
 
 from ._nix_api_store import ffi, lib as lib_unwrapped
 from .wrap import LibWrap
@@ -10,10 +23,120 @@ lib = LibWrap(lib_unwrapped)
 CData: TypeAlias = ffi.CData
 
 
+if typing.TYPE_CHECKING:
+    from .expr import State
+
+CHUNK_SIZE = 1 << 20
+
+
 class StorePath:
     """ A path pointing to the Nix store """
-    def __init__(self, ptr: ffi.CData) -> None:
+    def __init__(self, ptr: ffi.CData, path: Optional[str] = None) -> None:
         self._path = ptr
+        self.path = path
+
+    def __str__(self) -> str:
+        if self.path is None:
+            return super().__repr__()
+        return self.path
+
+    def __repr__(self) -> str:
+        return f"<StorePath {self.path}>"
+
+
+_BASE32_CHARS = "0123456789abcdfghijklmnpqrsvwxyz"
+
+
+def _base32(h: bytes) -> str:
+    """ Nix's base32 encoding, as used in store paths """
+    res = []
+    for n in range((len(h) * 8 - 1) // 5, -1, -1):
+        b = n * 5
+        i, j = b // 8, b % 8
+        c = h[i] >> j
+        if i + 1 < len(h):
+            c |= h[i + 1] << (8 - j)
+        res.append(_BASE32_CHARS[c & 0x1F])
+    return "".join(res)
+
+
+def _source_path(store_dir: str, name: str, nar_sha256: bytes) -> str:
+    """ The store path of a recursively hashed source without references, like builtins.path makes """
+    fingerprint = f"source:sha256:{nar_sha256.hex()}:{store_dir}:{name}"
+    digest = hashlib.sha256(fingerprint.encode()).digest()
+    compressed = bytearray(20)
+    for i, b in enumerate(digest):
+        compressed[i % 20] ^= b
+    return f"{store_dir}/{_base32(bytes(compressed))}-{name}"
+
+
+class _NarHasher:
+    """ Computes the sha256 of the NAR serialization of a file or directory, streaming its contents """
+    def __init__(self) -> None:
+        self.h = hashlib.sha256()
+        self.write_str(b"nix-archive-1")
+
+    def write_str(self, data: bytes) -> None:
+        self.h.update(struct.pack("<Q", len(data)))
+        self.h.update(data)
+        self.h.update(bytes(-len(data) % 8))
+
+    def regular(self, size: int, chunks: Iterable[bytes | memoryview], executable: bool = False) -> None:
+        for s in (b"(", b"type", b"regular"):
+            self.write_str(s)
+        if executable:
+            self.write_str(b"executable")
+            self.write_str(b"")
+        self.write_str(b"contents")
+        self.h.update(struct.pack("<Q", size))
+        for chunk in chunks:
+            self.h.update(chunk)
+        self.h.update(bytes(-size % 8))
+        self.write_str(b")")
+
+    def path(self, path: str) -> None:
+        st = os.lstat(path)
+        if stat.S_ISLNK(st.st_mode):
+            for s in (b"(", b"type", b"symlink", b"target", os.fsencode(os.readlink(path)), b")"):
+                self.write_str(s)
+        elif stat.S_ISDIR(st.st_mode):
+            for s in (b"(", b"type", b"directory"):
+                self.write_str(s)
+            for name in sorted(os.fsencode(n) for n in os.listdir(path)):
+                for s in (b"entry", b"(", b"name", name, b"node"):
+                    self.write_str(s)
+                self.path(os.path.join(path, os.fsdecode(name)))
+                self.write_str(b")")
+            self.write_str(b")")
+        elif stat.S_ISREG(st.st_mode):
+            with open(path, "rb") as f:
+                self.regular(st.st_size, _chunks(f), bool(st.st_mode & stat.S_IXUSR))
+        else:
+            raise ValueError(f"can't add {path} to the store: not a regular file, directory or symlink")
+
+    def digest(self) -> bytes:
+        return self.h.digest()
+
+
+def _chunks(f: BinaryIO) -> Iterable[bytes]:
+    return iter(lambda: f.read(CHUNK_SIZE), b"")
+
+
+def _memory_chunks(data: memoryview) -> Iterable[memoryview]:
+    return (data[i:i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE))
+
+
+def _hash_bytes(data: bytes | memoryview) -> bytes:
+    view = memoryview(data).cast("B")
+    nar = _NarHasher()
+    nar.regular(len(view), _memory_chunks(view))
+    return nar.digest()
+
+
+def _hash_path(path: str) -> bytes:
+    nar = _NarHasher()
+    nar.path(path)
+    return nar.digest()
 
 
 class Store:
@@ -38,6 +161,11 @@ class Store:
             pm.append(ffi.NULL)
             params_c = ffi.new("char**[]", pm)
         self._store = ffi.gc(lib.nix_store_open(url_c, params_c), lib.nix_store_unref)
+        self.url = url
+        self.params = None if params is None else dict(params)
+        self.store_dir = os.environ.get("NIX_STORE_DIR", "/nix/store")
+        # used to add paths, the C API has no function for it
+        self._state: Optional[State] = None
 
     def get_uri(self) -> str:
         """ Get the URI of the Nix store """
@@ -55,13 +183,17 @@ class Store:
         """ Parse a /nix/store path into a StorePath """
         path_ct = ffi.new("char[]", path.encode())
         sp = lib.nix_store_parse_path(self._store, path_ct)
-        return StorePath(ffi.gc(sp, lib.nix_store_path_free))
+        return StorePath(ffi.gc(sp, lib.nix_store_path_free), path)
 
     def _ensure_store_path(self, path: StorePath | str) -> StorePath:
         if isinstance(path, StorePath):
             return path
         if isinstance(path, str):
             return self.parse_path(path)
+        # Derivation
+        drv_path = getattr(path, "drv_path", None)
+        if drv_path is not None:
+            return self.parse_path(drv_path)
         # value
         # if value is string: storepath(str)
         if "type" in path and str(path["type"]) == "derivation":
@@ -87,3 +219,274 @@ class Store:
 
         lib.nix_store_build(self._store, path._path, ffi.NULL, iter_callback)
         return res
+
+    def add_bytes(self, name: str, data: bytes | memoryview) -> StorePath:
+        """ Add a file with the given contents to the store, like builtins.path would.
+        Nothing is written when the path is already valid.
+        """
+        return self._add_bytes(name, data, _hash_bytes(data))
+
+    def add_file(self, name: str, fileobj: BinaryIO) -> StorePath:
+        """ Add the remaining contents of a binary file object to the store.
+        Seekable files are hashed first and only copied when the path is not valid yet,
+        others are copied to a temporary file while reading.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "contents")
+            if fileobj.seekable():
+                start = fileobj.tell()
+                size = fileobj.seek(0, os.SEEK_END) - start
+                fileobj.seek(start)
+                nar = _NarHasher()
+                nar.regular(size, _chunks(fileobj))
+                nar_hash = nar.digest()
+                path = _source_path(self.store_dir, name, nar_hash)
+                if self.is_valid_path(path):
+                    return self.parse_path(path)
+                fileobj.seek(start)
+            with open(fname, "wb") as f:
+                for chunk in _chunks(fileobj):
+                    f.write(chunk)
+            if fileobj.seekable():
+                return self._add(fname, name, nar_hash)
+            return self.add_path(fname, name)
+
+    def add_path(self, path: str | os.PathLike[str], name: Optional[str] = None) -> StorePath:
+        """ Add a file, directory or symlink to the store, hashing it first to skip copying valid paths """
+        path = os.path.abspath(path)
+        if name is None:
+            name = os.path.basename(path)
+        nar_hash = _hash_path(path)
+        store_path = _source_path(self.store_dir, name, nar_hash)
+        if self.is_valid_path(store_path):
+            return self.parse_path(store_path)
+        return self._add(path, name, nar_hash)
+
+    def add_many(self, items: Iterable[tuple[str, bytes | memoryview]], max_workers: int = 8) -> list[StorePath]:
+        """ Add many (name, contents) pairs concurrently.
+        Each worker hashes and adds through its own connection from the shared StorePool of this store,
+        which keeps its own State for adding, so nothing is serialized on one connection.
+        """
+        from . import gc
+        entries = list(items)
+        pool = StorePool.shared(self.url, self.params, max_workers)
+        # the workers evaluate builtins.path
+        gc.allow_register_threads()
+
+        def add(entry: tuple[str, bytes | memoryview]) -> str:
+            name, data = entry
+            with gc.registered_thread(), pool.connection() as store:
+                return str(store._add_bytes(name, data, _hash_bytes(data)))
+
+        with ThreadPoolExecutor(max_workers) as executor:
+            paths = list(executor.map(add, entries))
+        return [self.parse_path(path) for path in paths]
+
+    def _add_bytes(self, name: str, data: bytes | memoryview, nar_hash: bytes) -> StorePath:
+        path = _source_path(self.store_dir, name, nar_hash)
+        if self.is_valid_path(path):
+            return self.parse_path(path)
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "contents")
+            with open(fname, "wb") as f:
+                f.write(data)
+            return self._add(fname, name, nar_hash)
+
+    def _add(self, path: str, name: str, nar_hash: bytes) -> StorePath:
+        if self._state is None:
+            from .expr import State
+            self._state = State([], self)
+        res = self._state.builtin("path")(
+            {"path": PurePath(path), "name": name, "sha256": nar_hash.hex()}
+        )
+        return self.parse_path(str(res))
+
+
+@dataclass(frozen=True)
+class PoolStats:
+    """ Counters of a StorePool """
+    connections: int
+    "open connections, idle or in use"
+    in_use: int
+    "connections currently handed out"
+    opened: int
+    "connections opened since the pool was created"
+    discarded: int
+    "connections dropped because they failed a health check or were released as broken"
+    acquisitions: int
+    waits: int
+    "acquisitions that had to wait for a connection to be released"
+    wait_time: float
+    "total seconds spent waiting for a connection"
+    max_wait_time: float
+
+
+class StorePool:
+    """ A bounded pool of Store connections opened with the same url and params.
+
+    Connections are handed out one caller at a time, so threads querying the store
+    don't serialize on one handle, and at most `max_size` connections are open.
+    A State keeps using the Store it was created with, so hold the connection
+    for as long as the State is in use:
+
+        with pool.connection() as store:
+            state = State([], store)
+            ...
+    """
+    _shared: dict[tuple[Optional[str], tuple[tuple[str, str], ...]], StorePool] = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(
+        self,
+        url: Optional[str] = None,
+        params: Optional[dict[str, str]] = None,
+        max_size: int = 8,
+        health_check_interval: float = 30.0,
+    ) -> None:
+        """
+        :param url: The store to open, as for Store
+        :param params: Store parameters, as for Store
+        :param max_size: Maximum number of open connections
+        :param health_check_interval: Check connections that were idle for longer than this many seconds before handing them out
+        """
+        if max_size < 1:
+            raise ValueError("max_size should be at least 1")
+        self.url = url
+        self.params = None if params is None else dict(params)
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        # (store, time it was released), most recently used last
+        self._idle: list[tuple[Store, float]] = []
+        self._connections = 0
+        self._in_use = 0
+        self._closed = False
+        self._opened = 0
+        self._discarded = 0
+        self._acquisitions = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+
+    @classmethod
+    def shared(
+        cls, url: Optional[str] = None, params: Optional[dict[str, str]] = None, max_size: int = 8
+    ) -> StorePool:
+        """ The process-wide pool for (url, params), created with `max_size` on first use """
+        key = (url, tuple(sorted((params or {}).items())))
+        with cls._shared_lock:
+            pool = cls._shared.get(key)
+            if pool is None or pool._closed:
+                pool = cls._shared[key] = cls(url, params, max_size)
+            return pool
+
+    def acquire(self, timeout: Optional[float] = None) -> Store:
+        """ Take a connection from the pool, opening one if none is idle and the pool is not full.
+        Release it with release(), or use connection() instead.
+
+        :param timeout: Seconds to wait for a connection, or None to wait forever
+        :raises TimeoutError: when no connection became available in time
+        """
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        waited = False
+        while True:
+            with self._lock:
+                while True:
+                    if self._closed:
+                        raise RuntimeError("StorePool is closed")
+                    if self._idle or self._connections < self.max_size:
+                        break
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError(f"no store connection available after {timeout}s")
+                    waited = True
+                    self._available.wait(remaining)
+                if self._idle:
+                    store: Optional[Store]
+                    store, released = self._idle.pop()
+                else:
+                    store, released = None, 0.0
+                    self._connections += 1
+                self._in_use += 1
+            if store is None:
+                try:
+                    store = Store(self.url, self.params)
+                except BaseException:
+                    self._drop(discarded=False)
+                    raise
+                with self._lock:
+                    self._opened += 1
+            elif time.monotonic() - released > self.health_check_interval and not _healthy(store):
+                self._drop()
+                continue
+            break
+        elapsed = time.monotonic() - start
+        with self._lock:
+            self._acquisitions += 1
+            if waited:
+                self._waits += 1
+                self._wait_time += elapsed
+                self._max_wait_time = max(self._max_wait_time, elapsed)
+        return store
+
+    def release(self, store: Store, broken: bool = False) -> None:
+        """ Return a connection to the pool
+
+        :param broken: Close the connection instead of reusing it
+        """
+        if broken or self._closed:
+            self._drop(discarded=broken)
+            return
+        with self._lock:
+            self._in_use -= 1
+            self._idle.append((store, time.monotonic()))
+            self._available.notify()
+
+    @contextlib.contextmanager
+    def connection(self, timeout: Optional[float] = None) -> Iterator[Store]:
+        """ Use a connection from the pool for the duration of the with block """
+        store = self.acquire(timeout)
+        try:
+            yield store
+        finally:
+            self.release(store)
+
+    def stats(self) -> PoolStats:
+        with self._lock:
+            return PoolStats(
+                connections=self._connections,
+                in_use=self._in_use,
+                opened=self._opened,
+                discarded=self._discarded,
+                acquisitions=self._acquisitions,
+                waits=self._waits,
+                wait_time=self._wait_time,
+                max_wait_time=self._max_wait_time,
+            )
+
+    def close(self) -> None:
+        """ Close the idle connections, and connections in use once they are released """
+        with self._lock:
+            self._closed = True
+            self._connections -= len(self._idle)
+            self._idle.clear()
+            self._available.notify_all()
+
+    def _drop(self, discarded: bool = True) -> None:
+        with self._lock:
+            self._connections -= 1
+            self._in_use -= 1
+            if discarded:
+                self._discarded += 1
+            self._available.notify()
+
+
+def _healthy(store: Store) -> bool:
+    """ Check a connection with a round trip to the store """
+    try:
+        store.is_valid_path(f"{store.store_dir}/{'0' * 32}-health-check")
+    except Exception:
+        return False
+    return True
@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import contextlib
+import json
+import os
+import threading
+import time
+from collections.abc import Callable, Iterator
+from typing import Any, Optional
+
+from . import wrap
+
+__all__ = ["Tracer", "FunctionStats", "enable", "disable", "tracing"]
+
+
+class FunctionStats:
+    """ Call statistics of one C function """
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.calls = 0
+        self.total_ns = 0
+        # histogram[i] counts calls that took between 2**(i-1) and 2**i nanoseconds
+        self.histogram: list[int] = [0] * 64
+
+    def record(self, duration_ns: int) -> None:
+        self.calls += 1
+        self.total_ns += duration_ns
+        self.histogram[min(duration_ns.bit_length(), 63)] += 1
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "total_s": self.total_ns / 1e9,
+            "mean_us": self.total_ns / self.calls / 1e3 if self.calls else 0.0,
+            "histogram_ns": {
+                f"<{2 ** i}": count for i, count in enumerate(self.histogram) if count
+            },
+        }
+
+
+class Tracer:
+    """ Records calls made through LibWrap: per-function counts, cumulative time and latency histograms,
+    and optionally every call as an event for a Chrome trace.
+    """
+    def __init__(self, events: bool = False, max_events: int = 1_000_000) -> None:
+        """
+        :param events: Record every call, for write_chrome_trace
+        :param max_events: Stop recording events after this many
+        """
+        self.stats: dict[str, FunctionStats] = {}
+        self.events: Optional[list[tuple[str, int, int, int]]] = [] if events else None
+        self.max_events = max_events
+
+    def wrap(self, name: str, f: Callable[..., Any]) -> Callable[..., Any]:
+        stats = self.stats.setdefault(name, FunctionStats(name))
+        events = self.events
+        max_events = self.max_events
+        clock = time.perf_counter_ns
+
+        def traced(*args: Any, **kwargs: Any) -> Any:
+            start = clock()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                duration = clock() - start
+                stats.record(duration)
+                if events is not None and len(events) < max_events:
+                    events.append((name, start, duration, threading.get_ident()))
+
+        return traced
+
+    def report(self) -> dict[str, dict[str, Any]]:
+        """ Statistics per function, most time consuming first """
+        return {
+            s.name: s.to_dict()
+            for s in sorted(self.stats.values(), key=lambda s: s.total_ns, reverse=True)
+            if s.calls
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.report(), indent=2)
+
+    def write_chrome_trace(self, path: str) -> None:
+        """ Write the recorded events in the Chrome trace event format, for chrome://tracing or Perfetto """
+        if self.events is None:
+            raise RuntimeError("tracer was not recording events, pass events=True")
+        pid = os.getpid()
+        trace = {
+            "traceEvents": [
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": start / 1e3,
+                    "dur": duration / 1e3,
+                    "pid": pid,
+                    "tid": tid,
+                }
+                for name, start, duration, tid in self.events
+            ]
+        }
+        with open(path, "w") as f:
+            json.dump(trace, f)
+
+
+def enable(events: bool = False) -> Tracer:
+    """ Start tracing calls into Nix. Tracing is off by default and costs nothing while off. """
+    tracer = Tracer(events)
+    wrap.tracer = tracer
+    wrap.reset_all()
+    return tracer
+
+
+def disable() -> Optional[Tracer]:
+    """ Stop tracing, returning the tracer that was active """
+    tracer, wrap.tracer = wrap.tracer, None
+    wrap.reset_all()
+    return tracer
+
+
+@contextlib.contextmanager
+def tracing(events: bool = False) -> Iterator[Tracer]:
+    """ Trace the calls made in a with-block ::
+
+        with nix.trace.tracing() as t:
+            pkgs["hello"].build()
+        print(t.to_json())
+    """
+    tracer = enable(events)
+    try:
+        yield tracer
+    finally:
+        disable()
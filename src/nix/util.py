@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import threading
 import typing
 from typing import TypeAlias, TypeVar, Optional, Callable, Any
 from typing import Concatenate, ParamSpec
@@ -93,7 +94,188 @@ class AssertionError(NixError):
     pass
 
 
-ERR_MAP = {"nix::ThrownError": ThrownError, "nix::AssertionError": AssertionError}
+class Interrupted(NixError):
+    """ evaluation was interrupted """
+    pass
+
+
+class EvaluationTimeout(Interrupted):
+    """ evaluation took longer than its timeout """
+    pass
+
+
+class EvaluationCancelled(Interrupted):
+    """ evaluation was cancelled through a CancellationToken """
+    pass
+
+
+ERR_MAP = {
+    "nix::ThrownError": ThrownError,
+    "nix::AssertionError": AssertionError,
+    "nix::Interrupted": Interrupted,
+}
+
+
+class CancellationToken:
+    """ Cancels the evaluations it was passed to. Can be cancelled from any thread. """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._watchdogs: set[Watchdog] = set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def cancel(self) -> None:
+        """ Interrupt running evaluations using this token, and make future ones fail immediately """
+        with self._lock:
+            self._cancelled = True
+            watchdogs = list(self._watchdogs)
+        for w in watchdogs:
+            w.fire(EvaluationCancelled)
+
+
+class _ThreadState(threading.local):
+    def __init__(self) -> None:
+        self.watchdog: Optional[Watchdog] = None
+        # Nix throws Interrupted at most once per thread
+        self.interrupted = False
+
+
+_thread = _ThreadState()
+
+
+def interruptible() -> bool:
+    """ Whether a Watchdog can still interrupt evaluations on the current thread, see watched() """
+    return not _thread.interrupted
+
+
+class Watchdog:
+    """ Interrupts the Nix evaluation running in its with-block after a timeout or on cancellation.
+
+    This installs Nix's per-thread interrupt check on the thread that enters the with-block,
+    so evaluations on other threads keep running, and the State stays usable afterwards.
+    Watchdogs nest: when an enclosing one fires, the evaluation is interrupted too.
+
+    Nix throws Interrupted only once per thread, see watched() for running evaluations that can be interrupted repeatedly.
+    """
+    _lock = threading.Lock()
+
+    def __init__(
+        self, timeout: Optional[float] = None, cancel: Optional[CancellationToken] = None
+    ) -> None:
+        """
+        :param timeout: Seconds after which to interrupt the evaluation
+        :param cancel: Token that interrupts the evaluation when cancelled
+        """
+        self.timeout = timeout
+        self.cancel = cancel
+        self._reason: Optional[type[Interrupted]] = None
+        self._done = False
+        self._timer: Optional[threading.Timer] = None
+        # polled by nix::checkInterrupt() on the thread that entered this watchdog
+        self._flag = ffi.new("int*")
+        self._outer: Optional[Watchdog] = None
+        self._inner: Optional[Watchdog] = None
+
+    def __enter__(self) -> Watchdog:
+        if self.cancel is not None:
+            with self.cancel._lock:
+                if self.cancel._cancelled:
+                    raise EvaluationCancelled("evaluation cancelled")
+                self.cancel._watchdogs.add(self)
+        with Watchdog._lock:
+            self._outer = _thread.watchdog
+            if self._outer is not None:
+                self._outer._inner = self
+                if self._outer._flag[0]:
+                    lib.py_nix_raise_interrupt_flag(self._flag)
+        _thread.watchdog = self
+        lib.py_nix_set_interrupt_flag(self._flag)
+        if self.timeout is not None:
+            self._timer = threading.Timer(self.timeout, self.fire, (EvaluationTimeout,))
+            self._timer.daemon = True
+            self._timer.start()
+        return self
+
+    def fire(self, reason: type[Interrupted]) -> None:
+        """ Interrupt the evaluation, unless it has finished already. Can be called from any thread, also before entering. """
+        with Watchdog._lock:
+            if self._done or self._reason is not None:
+                return
+            self._reason = reason
+            # only the innermost watchdog's flag is polled
+            w: Optional[Watchdog] = self
+            while w is not None:
+                lib.py_nix_raise_interrupt_flag(w._flag)
+                w = w._inner
+
+    def __exit__(self, type: Any, value: Any, traceback: Any) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        if self.cancel is not None:
+            with self.cancel._lock:
+                self.cancel._watchdogs.discard(self)
+        with Watchdog._lock:
+            self._done = True
+            if self._outer is not None:
+                self._outer._inner = None
+            fired = bool(self._flag[0])
+        _thread.watchdog = self._outer
+        lib.py_nix_set_interrupt_flag(ffi.NULL if self._outer is None else self._outer._flag)
+        if fired:
+            # Nix may have thrown Interrupted on this thread, even if the evaluation finished anyway
+            _thread.interrupted = True
+        if self._reason is not None and isinstance(value, NixAPIError):
+            if self._reason is EvaluationTimeout:
+                raise EvaluationTimeout(f"evaluation timed out after {self.timeout}s") from value
+            raise self._reason("evaluation cancelled") from value
+
+
+def watched(
+    timeout: Optional[float],
+    cancel: Optional[CancellationToken],
+    fn: Callable[P, R],
+    *args: P.args,
+    **kwargs: P.kwargs,
+) -> R:
+    """ Call `fn`, interrupting it after `timeout` seconds or when `cancel` is cancelled.
+
+    After throwing Interrupted, Nix sets a thread-local flag (private to libnixutil) that keeps
+    it from throwing Interrupted on that thread again. So once the calling thread has been interrupted,
+    watched calls run on a fresh thread, registered with the garbage collector, while the calling thread waits.
+    """
+    if timeout is None and cancel is None:
+        return fn(*args, **kwargs)
+    if interruptible():
+        with Watchdog(timeout, cancel):
+            return fn(*args, **kwargs)
+    from . import gc
+    watchdog = Watchdog(timeout, cancel)
+    result: list[R] = []
+    error: list[BaseException] = []
+
+    def run() -> None:
+        with gc.registered_thread():
+            try:
+                with watchdog:
+                    result.append(fn(*args, **kwargs))
+            except BaseException as e:
+                error.append(e)
+
+    thread = threading.Thread(target=run, name="nix-watched")
+    thread.start()
+    try:
+        thread.join()
+    except BaseException:
+        # e.g. KeyboardInterrupt: don't give the State back to the caller while the thread still evaluates in it
+        watchdog.fire(EvaluationCancelled)
+        thread.join()
+        raise
+    if error:
+        raise error[0]
+    return result[0]
 
 
 class Settings:
@@ -114,18 +296,26 @@ class Settings:
         return ffi.string(value).decode()
 
 
+class _CtxStack(threading.local):
+    def __init__(self) -> None:
+        self.err_contexts: list[Context] = []
+        self.ctx_level = 0
+
+
 class Ctx:
-    err_contexts: list[Context] = []
-    ctx_level: int = 0
+    # per thread: evaluator threads (nix.aio), watchers (nix.watch) and
+    # pooled stores (nix.store) must not share error contexts with the main thread
+    _stack = _CtxStack()
 
     def __enter__(self) -> Context:
-        Ctx.ctx_level += 1
-        if len(Ctx.err_contexts) < Ctx.ctx_level:
-            Ctx.err_contexts.append(Context())
-        return Ctx.err_contexts[Ctx.ctx_level - 1]
+        stack = Ctx._stack
+        stack.ctx_level += 1
+        if len(stack.err_contexts) < stack.ctx_level:
+            stack.err_contexts.append(Context())
+        return stack.err_contexts[stack.ctx_level - 1]
 
     def __exit__(self, type: Any, value: Any, traceback: Any) -> None:
-        Ctx.ctx_level -= 1
+        Ctx._stack.ctx_level -= 1
 
 
 # settings
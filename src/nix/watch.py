@@ -0,0 +1,307 @@
+from __future__ import annotations
+
+import os
+import select
+import struct
+import threading
+import time
+from collections.abc import Callable, Hashable, Iterable
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from cffi import FFI  # type: ignore[import-untyped]
+
+from . import gc
+from .expr import State
+from .store import Store
+
+__all__ = ["Inotify", "LiveState"]
+
+_ffi = FFI()
+_ffi.cdef(
+    """
+int inotify_init1(int flags);
+int inotify_add_watch(int fd, const char *pathname, uint32_t mask);
+"""
+)
+_libc: Any = None
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_OPEN = 0x20
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+IN_CHANGED = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+_event = struct.Struct("iIII")
+
+
+class Inotify:
+    """ A minimal inotify wrapper, watching directory trees for opened and changed files """
+    def __init__(self) -> None:
+        global _libc
+        if _libc is None:
+            _libc = _ffi.dlopen(None)
+        self._fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(_ffi.errno, os.strerror(_ffi.errno))
+        self._dirs: dict[int, str] = {}
+
+    def watch(self, path: str) -> None:
+        """ Watch one directory """
+        wd = _libc.inotify_add_watch(self._fd, os.fsencode(path), IN_OPEN | IN_CHANGED)
+        if wd < 0:
+            raise OSError(_ffi.errno, os.strerror(_ffi.errno), path)
+        self._dirs[wd] = path
+
+    def watch_tree(self, root: str) -> None:
+        """ Watch a directory and its subdirectories, skipping hidden ones like .git """
+        for path, dirs, _ in os.walk(root):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            self.watch(path)
+
+    def wait(self, timeout: float) -> bool:
+        """ Wait until events are available """
+        return bool(select.select([self._fd], [], [], timeout)[0])
+
+    def read(self) -> list[tuple[str, int]]:
+        """ Read the pending events as (path, mask), without blocking """
+        res: list[tuple[str, int]] = []
+        while True:
+            try:
+                buf = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return res
+            pos = 0
+            while pos < len(buf):
+                wd, mask, _, length = _event.unpack_from(buf, pos)
+                pos += _event.size
+                name = buf[pos:pos + length].rstrip(b"\0")
+                pos += length
+                if mask & IN_Q_OVERFLOW:
+                    res.append(("", mask))
+                    continue
+                directory = self._dirs.get(wd)
+                if directory is None:
+                    continue
+                path = os.path.join(directory, os.fsdecode(name)) if name else directory
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.watch_tree(path)
+                res.append((path, mask))
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+@dataclass
+class _Generation:
+    state: State
+    opened: set[str] = field(default_factory=set)
+    "every file opened below the watched roots since this State was created"
+    warm: list[Any] = field(default_factory=list)
+    overflowed: bool = False
+    "events were lost while building it, so `opened` may be incomplete"
+
+
+@dataclass
+class _Result:
+    value: Any
+    deps: frozenset[str]
+    generation: _Generation
+    "keeps the State alive as long as results that may contain its Values are cached"
+
+
+def _default_state() -> State:
+    return State([], Store())
+
+
+class LiveState:
+    """ Caches evaluation results and keeps them up to date with the files below `roots`.
+
+    The files an evaluation reads are recorded with inotify. A State caches the files it parsed,
+    so later evaluations in the same State may not open them again. To stay correct,
+    a result depends on every file its State opened up to the end of that evaluation.
+
+    When a watched file changes, only the results depending on it are dropped,
+    and a fresh State is built (and warmed) in the background.
+    Cached results keep being served meanwhile, while evaluations that need the new State wait for it.
+    """
+    def __init__(
+        self,
+        roots: Iterable[str],
+        make_state: Callable[[], State] = _default_state,
+        warm: Iterable[Callable[[State], Any]] = (),
+        debounce: float = 0.1,
+    ) -> None:
+        """
+        :param roots: Directories to watch
+        :param make_state: Creates a new State
+        :param warm: Functions to run on every new State before it is used, for example to evaluate nixpkgs
+        :param debounce: Seconds to wait for more changes before rebuilding
+        """
+        self._make_state = make_state
+        self._warm = list(warm)
+        self._debounce = debounce
+        self._lock = threading.RLock()
+        self._rebuilt = threading.Condition(self._lock)
+        self._dirty = threading.Event()
+        self._closed = False
+        self._stale = False
+        self._results: dict[Hashable, _Result] = {}
+        self._current: Optional[_Generation] = None
+        # the files opened by the State being built, and whether they changed meanwhile
+        self._building: Optional[set[str]] = None
+        self._building_changed = False
+        self._building_overflowed = False
+        self._inotify = Inotify()
+        for root in roots:
+            self._inotify.watch_tree(root)
+        # the background threads must be registered with the GC, which needs this first
+        gc.allow_register_threads()
+        self._current = self._build()
+        self._threads = [
+            threading.Thread(target=self._watch_loop, name="nix-watch", daemon=True),
+            threading.Thread(target=self._rebuild_loop, name="nix-rebuild", daemon=True),
+        ]
+        for t in self._threads:
+            t.start()
+
+    @property
+    def state(self) -> State:
+        """ The current State """
+        return self._generation().state
+
+    @property
+    def warm_values(self) -> list[Any]:
+        """ The results of the warm functions on the current State """
+        return self._generation().warm
+
+    def evaluate(self, key: Hashable, fn: Callable[[State], Any]) -> Any:
+        """ Return the cached result for `key`, or compute it as `fn(state)` """
+        res = self._results.get(key)
+        if res is not None:
+            return res.value
+        with self._lock:
+            while self._stale and not self._closed:
+                self._rebuilt.wait()
+            res = self._results.get(key)
+            if res is not None:
+                return res.value
+            gen = self._generation()
+            self._process_events()
+            value = fn(gen.state)
+            changed = self._process_events()
+            if not (changed & gen.opened) and not (changed and gen.overflowed):
+                self._results[key] = _Result(value, frozenset(gen.opened), gen)
+            return value
+
+    def invalidate(self, key: Hashable) -> None:
+        self._results.pop(key, None)
+
+    def close(self) -> None:
+        self._closed = True
+        self._dirty.set()
+        with self._lock:
+            self._rebuilt.notify_all()
+        for t in self._threads:
+            t.join()
+        self._inotify.close()
+
+    def _generation(self) -> _Generation:
+        assert self._current is not None
+        return self._current
+
+    def _build(self) -> _Generation:
+        """ Create and warm a new State. Runs without holding the lock,
+        the watch thread records the files it opens meanwhile.
+        """
+        opened: set[str] = set()
+        with self._lock:
+            self._building = opened
+            self._building_changed = False
+            self._building_overflowed = False
+        try:
+            state = self._make_state()
+            warm = [w(state) for w in self._warm]
+        finally:
+            with self._lock:
+                self._process_events()
+                self._building = None
+        return _Generation(state, opened, warm, self._building_overflowed)
+
+    def _process_events(self) -> set[str]:
+        """ Record opened files and invalidate results depending on changed files. Called with the lock held. """
+        changed: set[str] = set()
+        overflow = False
+        current = self._current
+        for path, mask in self._inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+            elif mask & IN_OPEN:
+                if current is not None:
+                    current.opened.add(path)
+                if self._building is not None:
+                    self._building.add(path)
+            elif mask & IN_CHANGED:
+                changed.add(path)
+                # directory listings change too
+                if mask & (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO):
+                    changed.add(os.path.dirname(path))
+        if overflow or (changed and current is not None and current.overflowed):
+            self._results.clear()
+        elif changed:
+            for key, res in list(self._results.items()):
+                if res.deps & changed:
+                    del self._results[key]
+        if self._building is not None:
+            # the State being built may have read old contents, or opened files we didn't see
+            self._building_changed |= bool(changed & self._building)
+            self._building_overflowed |= overflow
+        if current is not None and (overflow or changed & current.opened or (changed and current.overflowed)):
+            self._stale = True
+            self._dirty.set()
+        return changed
+
+    def _watch_loop(self) -> None:
+        while not self._closed:
+            if self._inotify.wait(0.5):
+                with self._lock:
+                    self._process_events()
+
+    def _rebuild_loop(self) -> None:
+        # evaluates, so Boehm needs to know about this thread
+        with gc.registered_thread():
+            # events were lost during the last build, which is retried once
+            retry_overflow = True
+            while True:
+                self._dirty.wait()
+                if self._closed:
+                    return
+                time.sleep(self._debounce)
+                self._dirty.clear()
+                try:
+                    gen = self._build()
+                except Exception:
+                    # keep serving from the old State, and try again on the next change
+                    with self._lock:
+                        self._stale = False
+                        self._rebuilt.notify_all()
+                    continue
+                with self._lock:
+                    self._current = gen
+                    # changes that only concern the old State don't matter anymore
+                    self._dirty.clear()
+                    if self._building_changed or (gen.overflowed and retry_overflow):
+                        retry_overflow = self._building_changed
+                        self._dirty.set()
+                        continue
+                    retry_overflow = True
+                    self._stale = False
+                    self._rebuilt.notify_all()
@@ -2,14 +2,16 @@ from __future__ import annotations
 
 import typing
 import re
+import weakref
 
 from collections.abc import Callable
-from typing import Any, Concatenate
+from typing import Any, Concatenate, Optional
 
 from .util import Ctx, CData
 
 if typing.TYPE_CHECKING:
     from ._nix_api_types import Lib
+    from .trace import Tracer
 
 
 P = typing.ParamSpec("P")
@@ -45,16 +47,37 @@ def wrap_ffi(
     return wrap_null
 
 
+# set by nix.trace while tracing is enabled
+tracer: Optional[Tracer] = None
+
+_instances: weakref.WeakSet[LibWrap] = weakref.WeakSet()
+
+
+def reset_all() -> None:
+    """Drop the wrapped functions cached on all LibWraps, so they get wrapped again on next use"""
+    for lw in _instances:
+        lw._reset()
+
+
 class LibWrap:
     """Wrap an ffi.lib for nix error checking"""
 
     def __init__(self, thing: Lib):
         self._thing = thing
+        _instances.add(self)
 
     def __getattr__(self, attr: str) -> Any:
         r: Any = wrap_ffi(getattr(self._thing, attr))
+        if tracer is not None and callable(r):
+            r = tracer.wrap(attr, r)
+        # cached, so later lookups don't go through __getattr__ at all
         setattr(self, attr, r)
         return r
 
+    def _reset(self) -> None:
+        for attr in list(vars(self)):
+            if attr != "_thing":
+                delattr(self, attr)
+
     def __dir__(self) -> list[str]:
         return dir(self._thing)
@@ -0,0 +1,37 @@
+import asyncio
+
+import pytest
+
+expr = pytest.importorskip("nix.expr")
+store = pytest.importorskip("nix.store")
+
+SLOW = """
+builtins.foldl' (a: i: builtins.foldl' (b: j: b + 1) a (builtins.genList (x: x) 10000)) 0 (builtins.genList (x: x) 100000)
+"""
+
+
+@pytest.fixture(scope="module")
+def state():
+    return expr.State([], store.Store())
+
+
+def test_two_event_loops(state):
+    for _ in range(2):
+        assert asyncio.run(state.eval_async("1 + 1")).force() == 2
+
+
+def test_cancel_then_evaluate(state):
+    async def main():
+        for _ in range(2):
+            task = asyncio.ensure_future(state.eval_async(SLOW))
+            await asyncio.sleep(0.2)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        attrs = await state.eval_async("{ a.b = 1; c = [ 2 3 ]; }")
+        assert sorted(await attrs.keys_async()) == ["a", "c"]
+        assert (await attrs.select_async("a.b")).force() == 1
+        elements = await (await attrs.select_async(["c"])).elements_async()
+        assert [e.force() for e in elements] == [2, 3]
+
+    asyncio.run(main())
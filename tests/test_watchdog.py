@@ -0,0 +1,54 @@
+import threading
+
+import pytest
+
+expr = pytest.importorskip("nix.expr")
+store = pytest.importorskip("nix.store")
+util = pytest.importorskip("nix.util")
+
+# about a billion additions, with small lists
+SLOW = """
+builtins.foldl' (a: i: builtins.foldl' (b: j: b + 1) a (builtins.genList (x: x) 10000)) 0 (builtins.genList (x: x) 100000)
+"""
+
+
+@pytest.fixture(scope="module")
+def state():
+    return expr.State([], store.Store())
+
+
+def test_two_timeouts_in_a_row(state):
+    for _ in range(2):
+        with pytest.raises(util.EvaluationTimeout):
+            state.eval_string(SLOW, ".", timeout=0.2)
+    assert state.eval_string("1 + 1", ".").force() == 2
+
+
+def test_cancel_after_timeout(state):
+    with pytest.raises(util.EvaluationTimeout):
+        state.eval_string(SLOW, ".", timeout=0.2)
+    token = util.CancellationToken()
+    threading.Timer(0.2, token.cancel).start()
+    with pytest.raises(util.EvaluationCancelled):
+        state.eval_string(SLOW, ".", cancel=token)
+    assert state.eval_string("1 + 1", ".", timeout=10).force() == 2
+
+
+def test_timeout_only_interrupts_its_thread(state):
+    gc = pytest.importorskip("nix.gc")
+    errors = []
+
+    def slow() -> None:
+        with gc.registered_thread():
+            try:
+                state.eval_string(SLOW, ".", timeout=0.2)
+            except util.EvaluationTimeout as e:
+                errors.append(e)
+
+    other = expr.State([], store.Store())
+    thread = threading.Thread(target=slow)
+    thread.start()
+    # runs past the other thread's timeout
+    assert other.eval_string("builtins.length (builtins.genList (x: x) 3000000)", ".").force() == 3000000
+    thread.join()
+    assert len(errors) == 1